@@ -0,0 +1,103 @@
+# Crawls a local synthetic site end to end and reports throughput, peak memory and database size.
+# Run from the repository root: python -m Benchmarks.bench_crawl --pages 2000 -- -e async -c 50
+# Arguments after -- are passed to link_checker, after the defaults below so they can override them.
+
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from Benchmarks.fake_site import add_site_arguments, site_from_args
+
+LINK_CHECKER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "link_checker.py")
+
+# Every run starts from scratch with no politeness limits, so only the crawler is measured
+DEFAULT_ARGS = ["-r", "--host-rate", "0", "--host-connections", "0", "--no-cache",
+                "--progress-interval", "0", "--log-level", "WARNING", "--no-browser"]
+
+
+def crawl(url, crawler_args, workdir):
+    # Runs link_checker in a child process, returns (seconds, peak RSS in MB, exit status)
+    command = [sys.executable, LINK_CHECKER, url] + DEFAULT_ARGS + [
+        "--log-file", os.path.join(workdir, "link_checker.log"),
+        "--report-file", os.path.join(workdir, "report.html"),
+        "--metrics-file", os.path.join(workdir, "metrics.json")] + crawler_args
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL)
+    # wait4 rather than wait gives the peak RSS of this child alone, parser processes it waited for included
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return elapsed, usage.ru_maxrss / 1024, process.returncode  # ru_maxrss is in KB on Linux
+
+
+def database_stats(workdir):
+    # (URLs checked, broken URLs, bytes) of the crawl's database including its WAL
+    db = os.path.join(workdir, "links.db")
+    size = sum(os.path.getsize(db + suffix) for suffix in ("", "-wal", "-shm") if os.path.exists(db + suffix))
+    conn = sqlite3.connect(db)
+    try:
+        checked, broken = conn.execute(
+            "SELECT COUNT(status), COUNT(CASE WHEN status >= 400 OR status <= 0 THEN 1 END) FROM url").fetchone()
+    finally:
+        conn.close()
+    return checked, broken, size
+
+
+def stage_seconds(workdir):
+    # Summed seconds per crawl stage from the run's metrics file
+    with open(os.path.join(workdir, "metrics.json")) as f:
+        histograms = json.load(f)["histograms"]
+
+    def total(name):
+        series = histograms.get(name, {})
+        if "sum" in series:
+            return series["sum"]
+        return sum(histogram["sum"] for histogram in series.values())
+
+    return [total(name) for name in ("fetch_seconds", "parse_seconds", "db_wait_seconds")]
+
+
+def main():
+    argParser = argparse.ArgumentParser(description="Benchmark link_checker against a local synthetic site.")
+    add_site_arguments(argParser)
+    argParser.add_argument("--runs", type=int, default=3, help="Crawls to run, each is reported and the best is summarized.")
+    argParser.add_argument("crawler_args", nargs=argparse.REMAINDER, help="Arguments for link_checker, after --.")
+    args = argParser.parse_args()
+    crawler_args = args.crawler_args[1:] if args.crawler_args[:1] == ["--"] else args.crawler_args
+    if not any(arg in ("-d", "--depth") for arg in crawler_args):
+        crawler_args = ["-d", "0"] + crawler_args  # The whole site unless told otherwise
+
+    server = site_from_args(args).serve()
+    print("Site: %d pages, fan-out %d, %.0f%% broken extra links, %.0f ms latency, %d byte pages at %s" % (
+        args.pages, args.fan_out, args.broken_ratio * 100, args.latency, args.page_size, server.url))
+    print("link_checker %s" % " ".join(DEFAULT_ARGS + crawler_args))
+    print("%4s %9s %8s %9s %8s %9s %9s %9s %9s %10s" % (
+        "run", "seconds", "URLs", "URLs/sec", "broken", "peak MB", "DB MB", "fetch s", "parse s", "db wait s"))
+
+    best = None
+    for run in range(1, args.runs + 1):
+        with tempfile.TemporaryDirectory(prefix="bench_crawl_") as workdir:
+            elapsed, peak, status = crawl(server.url + "/page/0", crawler_args, workdir)
+            if status != 0:
+                print("%4d link_checker exited with status %d" % (run, status))
+                continue
+            checked, broken, size = database_stats(workdir)
+            fetch, parse, db_wait = stage_seconds(workdir)
+        rate = checked / elapsed
+        print("%4d %9.2f %8d %9.1f %8d %9.1f %9.2f %9.2f %9.2f %10.2f" % (
+            run, elapsed, checked, rate, broken, peak, size / 2 ** 20, fetch, parse, db_wait))
+        best = rate if best is None else max(best, rate)
+
+    server.shutdown()
+    if best is not None:
+        print("best %.1f URLs/sec" % best)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# Compares the link extractors in Include.LinkExtractor on large synthetic pages.
+# Run from the repository root: python -m Benchmarks.bench_link_extractor
+
+import argparse
+import random
+import time
+
+from Include.LinkExtractor import EXTRACTORS
+
+
+def make_page(links, filler):
+    # Navigation-heavy page: repeated header/footer links plus nested markup and body text between anchors
+    rnd = random.Random(links)
+    nav = "".join("<li><a class='nav' href='/section/%d/'>Section %d</a></li>" % (i, i) for i in range(40))
+    parts = ["<html><head><title>Benchmark</title><script>var x = '<a href=\"/not-a-link\">';</script></head><body>",
+             "<ul class='nav'>%s</ul>" % nav]
+    for i in range(links):
+        parts.append("<div class='item'><p>%s</p><a href='/page/%d?id=%d&amp;ref=bench#top' title='Item %d'>Item %d</a></div>" % (
+            "lorem ipsum dolor sit amet " * filler, rnd.randint(0, 10 ** 6), i, i, i))
+    parts.append("<footer><ul>%s</ul></footer></body></html>" % nav)
+    return "".join(parts)
+
+
+def bench(extractor, page, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        hrefs = extractor(page)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(hrefs)
+
+
+def main():
+    argParser = argparse.ArgumentParser(description="Benchmark link extractors on synthetic pages.")
+    argParser.add_argument("--links", type=int, nargs="+", default=[100, 1000, 10000], help="Number of anchors per page.")
+    argParser.add_argument("--filler", type=int, default=5, help="Words of body text between anchors.")
+    argParser.add_argument("--repeat", type=int, default=5, help="Runs per extractor, the best time is reported.")
+    args = argParser.parse_args()
+
+    print("%8s %10s %10s %12s %8s" % ("links", "page KB", "extractor", "best ms", "speedup"))
+    for links in args.links:
+        page = make_page(links, args.filler)
+        baseline = None
+        for name in ("bs4", "stream"):
+            elapsed, found = bench(EXTRACTORS[name], page, args.repeat)
+            baseline = baseline or elapsed
+            print("%8d %10d %10s %12.2f %7.1fx   (%d hrefs)" % (
+                links, len(page) // 1024, name, elapsed * 1000, baseline / elapsed, found))
+
+
+if __name__ == "__main__":
+    main()
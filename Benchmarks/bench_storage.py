@@ -0,0 +1,108 @@
+# Compares the standard and --compact-db database schemas on a synthetic crawl: size on disk, write time,
+# URL lookups and the report query.
+# Run from the repository root: python -m Benchmarks.bench_storage --urls 200000
+
+import argparse
+from contextlib import closing
+import logging
+import os
+import random
+import tempfile
+import time
+
+from Include.DbWriter import DbWriter
+import link_checker as lc
+
+
+def make_urls(count, hosts, seed):
+    # URLs shaped like those of real sites, a few hosts with many long paths
+    rnd = random.Random(seed)
+    sections = ["library", "elections", "archives", "corps", "news", "events", "about", "search"]
+    return ["https://www.site%d.example.org/%s/%s/%d/page-%d.html%s" % (
+        rnd.randrange(hosts), rnd.choice(sections), rnd.choice(sections), rnd.randrange(2000), n,
+        "?id=%d&lang=en" % rnd.randrange(10 ** 6) if rnd.random() < 0.2 else "") for n in range(count)]
+
+
+def build(workdir, compact, urls, args):
+    # Writes the crawl through link_checker's own write path, returns the seconds it took
+    lc.set_db(os.path.join(workdir, "links.db"))
+    lc.initialize_db(True, compact)
+    lc.db_writer = DbWriter(lc.db_name)
+    rnd = random.Random(args.seed)
+    start = time.perf_counter()
+    try:
+        ids = []
+        for first in range(0, len(urls), 1000):
+            found = lc.insert_urls(urls[first:first + 1000], 1)
+            ids += [found[url][0] for url in urls[first:first + 1000]]
+
+        # One page in links_per_page is parsed, linking to as many others, so every URL has about one parent
+        for parent in ids[::args.links_per_page]:
+            children = {}
+            for child in rnd.sample(ids, args.links_per_page):
+                children[child] = children.get(child, 0) + 1
+            lc.add_links(parent, list(children.items()))
+        for url_id in ids:
+            lc.update_url_status(url_id, 404 if rnd.random() < args.broken_ratio else 200, 0)
+    finally:
+        lc.db_writer.close()
+        lc.db_writer = None
+    with closing(lc.get_connection()) as conn:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+    return time.perf_counter() - start
+
+
+def database_size():
+    return sum(os.path.getsize(lc.db_name + suffix) for suffix in ("", "-wal", "-shm") if os.path.exists(lc.db_name + suffix))
+
+
+def best_of(runs, func):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    argParser = argparse.ArgumentParser(description="Benchmark the standard and compact link_checker database schemas.")
+    argParser.add_argument("--urls", type=int, default=100000, help="URLs in the synthetic crawl.")
+    argParser.add_argument("--hosts", type=int, default=50, help="Hosts the URLs are spread over.")
+    argParser.add_argument("--links-per-page", type=int, default=10, help="Links on each parsed page.")
+    argParser.add_argument("--broken-ratio", type=float, default=0.02, help="Share of URLs recorded as broken.")
+    argParser.add_argument("--lookups", type=int, default=20000, help="Known URLs looked up by insert_urls.")
+    argParser.add_argument("--runs", type=int, default=3, help="Runs of each query, the best is reported.")
+    argParser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic crawl.")
+    args = argParser.parse_args()
+
+    logging.disable(logging.WARNING)  # link_checker logs every write
+    urls = make_urls(args.urls, args.hosts, args.seed)
+    sample = random.Random(args.seed).sample(urls, min(args.lookups, len(urls)))
+    print("%d URLs on %d hosts, %d links per parsed page, %.0f%% broken" % (
+        args.urls, args.hosts, args.links_per_page, args.broken_ratio * 100))
+    print("%-9s %9s %9s %10s %10s %8s" % ("schema", "DB MB", "write s", "lookup s", "report s", "rows"))
+
+    results = {}
+    for compact in (False, True):
+        with tempfile.TemporaryDirectory(prefix="bench_storage_") as workdir:
+            written = build(workdir, compact, urls, args)
+            size = database_size()
+
+            def lookup():
+                for first in range(0, len(sample), 1000):
+                    lc.insert_urls(sample[first:first + 1000])
+
+            lookup_seconds, _ = best_of(args.runs, lookup)
+            report_seconds, rows = best_of(args.runs, lambda: sum(1 for _ in lc.get_error_urls()))
+        name = "compact" if compact else "standard"
+        results[name] = (size, report_seconds)
+        print("%-9s %9.1f %9.2f %10.3f %10.3f %8d" % (name, size / 2 ** 20, written, lookup_seconds, report_seconds, rows))
+
+    print("compact is %.0f%% of the standard size, its report query takes %.0f%% of the time" % (
+        100 * results["compact"][0] / results["standard"][0], 100 * results["compact"][1] / results["standard"][1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# Compares link_checker.canonicalize_url with the urljoin + validate_url + parse_url pipeline it replaced.
+# canonicalize_url is memoized, the corpus repeats hrefs as real sites do, so it is timed both without and with its cache.
+# Run from the repository root: python -m Benchmarks.bench_url_canonicalize
+
+import argparse
+import logging
+import random
+import time
+from urllib import parse
+
+import link_checker as lc
+
+# hrefs as they appear on real pages: navigation, relative paths, queries, fragments and non-HTTP schemes
+CORPUS = [
+    "/", "/library/", "/library/about.aspx", "/library/hours.aspx", "/library/contact.aspx#main",
+    "/elections/", "/elections/calendar.aspx", "/elections/candidates/", "/corps/", "/corps/search.aspx",
+    "/archives/", "/archives/RecordsManagement/", "/archives/RecordsManagement/default.aspx",
+    "../default.aspx", "./search?q=washington&page=2", "search?q=history&sort=date&page=1",
+    "?lang=es", "#top", "#content", "#", "javascript:void(0)", "mailto:library@sos.wa.gov",
+    "tel:+13607045200", "https://www.sos.wa.gov/library/", "https://www.sos.wa.gov/library/#contact",
+    "https://WWW.SOS.WA.GOV:443/library/libraries/default.aspx", "http://www.sos.wa.gov/elections",
+    "https://www.facebook.com/WaStateLibrary", "https://twitter.com/WaStateLibrary",
+    "https://www.youtube.com/user/WashingtonStateLibrary", "https://www.instagram.com/wastatelibrary/",
+    "https://www.washington.edu/", "https://www.wsu.edu/", "https://access.wa.gov/",
+    "https://www.loc.gov/", "https://www.worldcat.org/search?q=washington+history&qt=results_page",
+    "https://catalog.sos.wa.gov/search~S1?/Xwashington&searchscope=1&SORT=D",
+    "/library/news.aspx?id=1204&category=events", "/library/news.aspx?id=1205&category=events#comments",
+    "/library/events/2019/10/", "/library/events/2019/11/", "/library/blog/page/2/",
+    "https://www.sos.wa.gov/_assets/library/library-logo.png", "/_assets/css/site.css",
+    "//fonts.googleapis.com/css?family=Open+Sans", "http://localhost:8080/test", "  /library/faq.aspx  ",
+    "/library/Jobs.aspx", "/library/jobs.aspx", "https://sos.wa.gov/library/search?testquery=5&testanswer=5",
+]
+
+
+def legacy_parse_url(url, use_queries=True, keys=[]):
+    # parse_url as it was before canonicalize_url, including its missing "?" before the query
+    splitresult = parse.urlsplit(url)
+    parsed_url = splitresult.scheme + "://" + splitresult.netloc + splitresult.path
+    if use_queries and not keys:
+        parsed_url = parsed_url + splitresult.query
+    if keys and splitresult.query:
+        query_args = dict(x.partition("=")[::2] for x in splitresult.query.split("&"))
+        parsed_query_args = [ak + "=" + query_args[ak] for ak in keys if ak in query_args]
+        if parsed_query_args:
+            parsed_url = parsed_url + "?" + "&".join(parsed_query_args)
+    return parsed_url
+
+
+def legacy(base, href, use_queries, keys):
+    link = parse.urljoin(base, href, False)
+    if lc.validate_url(link):
+        return legacy_parse_url(link, use_queries, keys)
+    return None
+
+
+def cold(base, href, use_queries, keys):
+    # Every href canonicalized from scratch, as for a URL seen for the first time
+    return lc.canonicalize_url.__wrapped__(base, href, use_queries, keys)
+
+
+def warm(base, href, use_queries, keys):
+    return lc.canonicalize_url(base, href, use_queries, keys)
+
+
+def run(func, pages, keys):
+    start = time.perf_counter()
+    found = 0
+    for base, hrefs in pages:
+        for href in hrefs:
+            if func(base, href, True, keys) is not None:
+                found += 1
+    return time.perf_counter() - start, found
+
+
+def main():
+    argParser = argparse.ArgumentParser(description="Benchmark URL canonicalization over a corpus of real hrefs.")
+    argParser.add_argument("--pages", type=int, default=2000, help="Number of simulated pages.")
+    argParser.add_argument("--links", type=int, default=200, help="hrefs per page, drawn from the corpus.")
+    argParser.add_argument("-ak", "--acceptable-keys", nargs="+", help="Query keys to keep, as with link_checker.")
+    argParser.add_argument("--log-level", default="INFO", help="Log level while benchmarking, link_checker logs at INFO by default.")
+    args = argParser.parse_args()
+
+    logging.basicConfig(level=args.log_level, handlers=[logging.NullHandler()])
+    rnd = random.Random(0)
+    bases = ["https://www.sos.wa.gov/library/page%d.aspx" % i for i in range(50)]
+    pages = [(rnd.choice(bases), [rnd.choice(CORPUS) for _ in range(args.links)]) for _ in range(args.pages)]
+    keys = tuple(args.acceptable_keys) if args.acceptable_keys else None
+
+    legacy_time, legacy_found = run(legacy, pages, keys)
+    cold_time, cold_found = run(cold, pages, keys)
+    lc.canonicalize_url.cache_clear()
+    warm_time, warm_found = run(warm, pages, keys)
+
+    total = args.pages * args.links
+    print("%d hrefs (%d distinct in corpus) on %d pages" % (total, len(CORPUS), args.pages))
+    print("%12s %10s %14s %10s" % ("pipeline", "seconds", "hrefs/sec", "kept"))
+    print("%12s %10.3f %14d %10d" % ("legacy", legacy_time, total / legacy_time, legacy_found))
+    print("%12s %10.3f %14d %10d" % ("cold cache", cold_time, total / cold_time, cold_found))
+    print("%12s %10.3f %14d %10d" % ("warm cache", warm_time, total / warm_time, warm_found))
+    print("speedup %.1fx cold, %.1fx warm, %s" % (
+        legacy_time / cold_time, legacy_time / warm_time, lc.canonicalize_url.cache_info()))
+
+
+if __name__ == "__main__":
+    main()
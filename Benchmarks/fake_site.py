@@ -0,0 +1,126 @@
+# Synthetic website served from memory, so crawls can be measured without the network.
+# Run from the repository root: python -m Benchmarks.fake_site --pages 1000 --port 8000
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import random
+import threading
+import time
+
+
+class QuietServer(ThreadingHTTPServer):
+    """ Server ignoring clients that drop keep-alive connections, as crawlers do when they finish """
+
+    def handle_error(self, request, client_address):
+        return
+
+
+class FakeSite:
+    """ Deterministic site of pages /page/0 to /page/<pages - 1>, every page reachable from /page/0
+
+    Page n links to its fan_out children in a tree (n * fan_out + 1 onwards), to a few random
+    pages already in the tree and, with probability broken_ratio per link, to a missing page.
+    """
+
+    def __init__(self, pages=1000, fan_out=10, broken_ratio=0.05, latency=0.0, page_size=0, seed=0):
+        self.pages = pages
+        self.fan_out = fan_out
+        self.broken_ratio = broken_ratio
+        self.latency = latency
+        self.page_size = page_size
+        self.seed = seed
+
+    def links(self, n):
+        rnd = random.Random(self.seed * 1000003 + n)
+        links = ["/page/%d" % child for child in range(n * self.fan_out + 1, min((n + 1) * self.fan_out + 1, self.pages))]
+        links += ["/page/%d" % rnd.randrange(self.pages) for _ in range(self.fan_out // 2)]  # Repeats exercise deduplication
+        links += ["/missing/%d-%d" % (n, i) for i in range(self.fan_out) if rnd.random() < self.broken_ratio]
+        rnd.shuffle(links)
+        return links
+
+    def page(self, n):
+        body = "".join("<li><a href='%s'>Link %d</a></li>" % (link, i) for i, link in enumerate(self.links(n)))
+        html = "<html><head><title>Page %d</title></head><body><ul>%s</ul>" % (n, body)
+        # Pad with body text, not links, up to page_size bytes
+        filler = self.page_size - len(html) - len("</body></html>")
+        if filler > 0:
+            html += "<p>%s</p>" % ("lorem ipsum " * (filler // 12 + 1))[:max(filler - 7, 0)]
+        return (html + "</body></html>").encode()
+
+    def response(self, path):
+        """ (status, body) for path """
+        if path.startswith("/page/") and path[6:].isdigit() and int(path[6:]) < self.pages:
+            return 200, self.page(int(path[6:]))
+        if path == "/":
+            return 200, self.page(0)
+        return 404, b"<html><body>Not found</body></html>"
+
+    def handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, like a real server
+            # Headers and body go out in separate writes, with Nagle the body waits for the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.respond(True)
+
+            def do_HEAD(self):
+                self.respond(False)
+
+            def respond(self, body):
+                if site.latency:
+                    time.sleep(site.latency)
+                status, data = site.response(self.path.split("?")[0])
+                self.send_response(status)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                if body:
+                    self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                return
+
+        return Handler
+
+    def serve(self, host="127.0.0.1", port=0):
+        """ Start serving on a daemon thread, returns the server, its base URL is server.url """
+        server = QuietServer((host, port), self.handler())
+        server.daemon_threads = True
+        server.url = "http://%s:%d" % server.server_address[:2]
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def add_site_arguments(argParser):
+    argParser.add_argument("--pages", type=int, default=1000, help="Number of pages on the site.")
+    argParser.add_argument("--fan-out", type=int, default=10, help="New pages linked from each page.")
+    argParser.add_argument("--broken-ratio", type=float, default=0.05, help="Chance of each extra link pointing to a missing page.")
+    argParser.add_argument("--latency", type=float, default=0.0, help="Milliseconds the server waits before every response.")
+    argParser.add_argument("--page-size", type=int, default=0, help="Bytes each page is padded to with body text.")
+    argParser.add_argument("--seed", type=int, default=0, help="Seed of the random links, the same seed serves the same site.")
+
+
+def site_from_args(args):
+    return FakeSite(args.pages, args.fan_out, args.broken_ratio, args.latency / 1000, args.page_size, args.seed)
+
+
+def main():
+    argParser = argparse.ArgumentParser(description="Serve a synthetic website for offline crawls.")
+    add_site_arguments(argParser)
+    argParser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    args = argParser.parse_args()
+
+    server = site_from_args(args).serve(port=args.port)
+    print("Serving %d pages at %s/page/0, Ctrl+C to stop" % (args.pages, server.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import logging
+from threading import Condition
+import time
+
+
+class ConcurrencyController:
+    """ Thread-safe limit on requests in flight, adapted between minimum and maximum as responses are recorded
+
+    Every interval seconds the limit is halved if more than error_ratio of the requests failed or were
+    throttled (status 0, 429 or 503), lowered by one if the median latency rose past latency_ratio times
+    the best seen, which means the server is queueing, and otherwise raised if requests had to wait for
+    a slot. Raises double the limit until it is first lowered, then add one. A raise that lowered
+    throughput is taken back. With minimum == maximum it is a plain semaphore.
+    """
+
+    throttled = (0, 429, 503)
+
+    def __init__(self, minimum=1, maximum=64, initial=None, interval=1.0, error_ratio=0.05, latency_ratio=2.0, metrics=None):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = min(max(initial or self.minimum, self.minimum), self.maximum)
+        self.interval = interval
+        self.error_ratio = error_ratio
+        self.latency_ratio = latency_ratio
+        self.metrics = metrics  # Include.Metrics instance the limit is reported to, if any
+        self.condition = Condition()
+        self.active = 0
+        self.waited = 0  # Acquires that found every slot taken since the last adjustment
+        self.latencies = []
+        self.failures = 0
+        self.window_start = time.monotonic()
+        self.best_latency = None
+        self.last_rate = None
+        self.raised_from = None  # Limit before the last raise, while its effect is unknown
+        self.slow_start = True
+        self._report()
+
+    @property
+    def adaptive(self):
+        return self.minimum < self.maximum
+
+    def acquire(self):
+        """ Wait for a slot under the current limit """
+        with self.condition:
+            if self.active >= self.limit:
+                self.waited += 1
+                while self.active >= self.limit:
+                    self.condition.wait()
+            self.active += 1
+
+    def try_acquire(self):
+        """ Take a slot if one is free, for callers that can't block such as an event loop """
+        with self.condition:
+            if self.active >= self.limit:
+                self.waited += 1
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def record(self, seconds, status):
+        """ Record a response, or status 0 for a request that failed, adjusting the limit once per interval """
+        if not self.adaptive:
+            return
+        with self.condition:
+            self.latencies.append(seconds)
+            if status in self.throttled:
+                self.failures += 1
+            now = time.monotonic()
+            if now - self.window_start >= self.interval:
+                self._adjust(now)
+
+    def _adjust(self, now):
+        count = len(self.latencies)
+        rate = count / max(now - self.window_start, 1e-9)
+        latency = sorted(self.latencies)[count // 2]
+        self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+        old = self.limit
+
+        if self.failures > count * self.error_ratio:
+            self.limit = max(self.minimum, self.limit // 2)
+            reason = "%d of %d requests failed or were throttled" % (self.failures, count)
+        elif latency > self.best_latency * self.latency_ratio:
+            self.limit = max(self.minimum, self.limit - 1)
+            reason = "median latency %.0f ms against a best of %.0f ms" % (latency * 1000, self.best_latency * 1000)
+        elif self.raised_from is not None and self.last_rate is not None and rate < self.last_rate:
+            self.limit = self.raised_from
+            reason = "throughput fell to %.1f/s from %.1f/s" % (rate, self.last_rate)
+        elif self.waited:
+            self.limit = min(self.maximum, self.limit * 2 if self.slow_start else self.limit + 1)
+            reason = "%d requests waited for a slot" % self.waited
+        else:
+            reason = None
+        self.raised_from = old if self.limit > old else None
+        if self.limit < old:
+            self.slow_start = False
+
+        if self.limit != old:
+            logging.info("Concurrency limit %d -> %d: %s." % (old, self.limit, reason))
+            self.condition.notify_all()
+        self._report()
+        self.last_rate = rate
+        self.latencies = []
+        self.failures = 0
+        self.waited = 0
+        self.window_start = now
+
+    def _report(self):
+        if self.metrics is not None:
+            self.metrics.gauge("concurrency_limit", self.limit)
+
+    def __str__(self):
+        return "limit %d (%d-%d), %d active" % (self.limit, self.minimum, self.maximum, self.active)
@@ -0,0 +1,144 @@
+from concurrent.futures import Future
+import logging
+from queue import Empty, Queue
+import sqlite3
+from threading import Lock, Thread
+import time
+
+
+class DbWriter(Thread):
+    """ Thread owning the only write connection, committing queued operations in batches
+
+    A failed commit is rolled back and reported to whoever is flushing. If the thread itself dies, every queued
+    future gets the error and later calls raise it instead of waiting on a writer that is gone.
+    """
+
+    STOP = object()
+
+    def __init__(self, db_name, batch_size=500, flush_interval=1.0, metrics=None):
+        Thread.__init__(self)
+        self.db_name = db_name
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.metrics = metrics  # Include.Metrics instance timing writes and commits, if any
+        self.ops = Queue()
+        self.lock = Lock()  # Orders queueing against the writer stopping, so nothing is queued after the last drain
+        self.error = None  # Why the writer thread stopped, once it has
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        try:
+            self._run()
+        except BaseException as e:
+            logging.critical("Database writer stopped: %s" % e)
+            with self.lock:
+                self.error = RuntimeError("Database writer stopped: %s" % e)
+            # Queueing now raises, so this drain sees every operation still waiting
+            while True:
+                try:
+                    _, _, future = self.ops.get_nowait()
+                except Empty:
+                    return
+                self._resolve(future, error=self.error)
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_name)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+
+        uncommitted = 0
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                func, args, future = self.ops.get(timeout=timeout)
+            except Empty:
+                # Flush interval elapsed with a partial batch
+                func, args, future = None, (), None
+
+            if func is self.STOP:
+                try:
+                    conn.commit()
+                    conn.close()
+                except Exception as e:
+                    self._resolve(future, error=e)
+                    raise
+                with self.lock:
+                    self.error = RuntimeError("Database writer closed")
+                self._resolve(future, True)
+                return
+
+            if func is not None:
+                try:
+                    start = time.perf_counter()
+                    result = func(conn, *args)
+                    if self.metrics is not None:
+                        self.metrics.observe("db_write_seconds", time.perf_counter() - start)
+                    self._resolve(future, result)
+                except Exception as e:
+                    logging.error("Database writer error: %s" % e)
+                    self._resolve(future, error=e)
+                uncommitted += 1
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            # A None func is either a timeout or an explicit flush request
+            if func is None or uncommitted >= self.batch_size:
+                error = None
+                if uncommitted:
+                    start = time.perf_counter()
+                    try:
+                        conn.commit()
+                    except sqlite3.Error as e:
+                        logging.error("Database writer lost %d operations, commit failed: %s" % (uncommitted, e))
+                        error = e
+                        if func is None:
+                            self._resolve(future, error=e)  # Before the rollback, which fails too if the connection is gone
+                        conn.rollback()
+                    if self.metrics is not None:
+                        self.metrics.observe("db_commit_seconds", time.perf_counter() - start)
+                    logging.debug("Committed %d queued database operations." % uncommitted)
+                uncommitted = 0
+                deadline = None
+                if func is None:
+                    self._resolve(future, True, error)  # A submitted operation's future already holds its result
+
+    def _resolve(self, future, result=None, error=None):
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _put(self, func, args, future):
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            self.ops.put((func, args, future))
+
+    def execute(self, func, *args):
+        """ Queue func(conn, *args) without waiting for it to run """
+        self._put(func, args, None)
+
+    def submit(self, func, *args):
+        """ Queue func(conn, *args), returning a Future for its result """
+        future = Future()
+        self._put(func, args, future)
+        return future
+
+    def flush(self):
+        """ Wait until every queued operation has been committed """
+        future = Future()
+        self._put(None, (), future)
+        future.result()
+
+    def close(self):
+        """ Commit outstanding operations and stop the writer thread """
+        future = Future()
+        try:
+            self._put(self.STOP, (), future)
+            future.result()
+        finally:
+            self.join()
@@ -0,0 +1,58 @@
+import socket
+from threading import Lock
+import time
+
+
+class DnsCache:
+    """ Thread-safe cache of socket.getaddrinfo results, failed lookups included, each kept for ttl seconds
+
+    install() puts it in front of socket.getaddrinfo for the whole process, which both requests and the
+    aiohttp thread resolver call, so a host is resolved once per ttl however many of its links are checked.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = {}  # getaddrinfo arguments -> (expiry, addresses or the gaierror raised)
+        self.hits = 0
+        self.misses = 0
+        self.resolve = socket.getaddrinfo
+
+    def getaddrinfo(self, *args, **kwargs):
+        """ socket.getaddrinfo, answered from the cache while the last answer is fresh """
+        key = args + tuple(sorted(kwargs.items()))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                result = entry[1]
+            else:
+                self.misses += 1
+                entry = None
+
+        if entry is None:
+            try:
+                result = self.resolve(*args, **kwargs)
+            except socket.gaierror as e:
+                result = e  # Names that don't resolve are the slowest to look up again
+            with self.lock:
+                self.entries[key] = (now + self.ttl, result)
+
+        if isinstance(result, socket.gaierror):
+            raise socket.gaierror(*result.args)
+        return list(result)
+
+    def install(self):
+        socket.getaddrinfo = self.getaddrinfo
+
+    def uninstall(self):
+        socket.getaddrinfo = self.resolve
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        total = self.hits + self.misses
+        return "%d entries, %d hits, %d misses (%.1f%% hit rate)" % (
+            len(self.entries), self.hits, self.misses, 100.0 * self.hits / total if total else 0.0)
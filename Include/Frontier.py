@@ -0,0 +1,132 @@
+import heapq
+from itertools import count
+from queue import Empty
+from threading import Condition
+import time
+
+
+class Frontier:
+    """ Thread-safe queue of (url, depth) handing out the shallowest URL first
+
+    At most max_size URLs are held in memory. Past that, put() drops URLs on the
+    understanding that they are pending in the database, and the frontier calls
+    refill(limit) for up to limit pending (url, depth) rows once it runs empty.
+    A URL handed out can be deferred, to be handed out again after a delay such as a retry backoff.
+    """
+
+    def __init__(self, max_size=0, refill=None):
+        self.heap = []
+        self.queued = {}  # url -> depth of its live heap entry
+        self.order = count()
+        self.in_flight = {}  # url -> depths it is being processed at
+        self.delayed = []  # heap of (due time, order, url, depth) of deferred URLs
+        self.deferred = {}  # url -> depth of its delayed entry
+        self.deferrals = {}  # url -> times it was deferred, until it is done
+        self.condition = Condition()
+        self.max_size = max_size
+        self.refill = refill
+        # Anything pending from an earlier run is only in the database
+        self.spilled = refill is not None
+
+    def put(self, url, depth):
+        """ Queue url at depth, replacing a queued entry for the same url only if depth is shallower """
+        with self.condition:
+            # A refill may already have handed out a URL its parent has not finished putting
+            if url in self.in_flight and min(self.in_flight[url]) <= depth:
+                return
+            if url in self.deferred:
+                return
+            if url in self.queued:
+                if self.queued[url] <= depth:
+                    return
+            elif self.max_size and len(self.queued) >= self.max_size and self.refill is not None:
+                self.spilled = True
+                return
+            self._push(url, depth)
+            self.condition.notify()
+
+    def _push(self, url, depth):
+        self.queued[url] = depth
+        heapq.heappush(self.heap, (depth, next(self.order), url))
+
+    def _pop(self):
+        while self.heap:
+            depth, _, url = heapq.heappop(self.heap)
+            # Entries superseded by a shallower put are skipped
+            if self.queued.get(url) == depth:
+                del self.queued[url]
+                self.in_flight.setdefault(url, []).append(depth)
+                return url, depth
+        return None
+
+    def _refill(self):
+        """ Reload pending URLs from the database, URLs being processed are still pending there """
+        limit = (self.max_size or 1000) + len(self.in_flight)
+        rows = list(self.refill(limit))
+        self.spilled = len(rows) >= limit
+        for url, depth in rows:
+            if url not in self.in_flight and url not in self.queued and url not in self.deferred:
+                self._push(url, depth)
+
+    def _release_due(self):
+        """ Queue deferred URLs whose delay is over """
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, url, depth = heapq.heappop(self.delayed)
+            del self.deferred[url]
+            if url not in self.queued or depth < self.queued[url]:
+                self._push(url, depth)
+
+    def next_due(self):
+        """ Seconds until the next deferred URL is due, or None if none is deferred """
+        with self.condition:
+            return max(self.delayed[0][0] - time.monotonic(), 0) if self.delayed else None
+
+    def get(self, block=True):
+        """ Return the next (url, depth), or None once the frontier is empty and no URL is in flight or deferred
+
+        Without block, raises queue.Empty instead of waiting on URLs in flight or deferred.
+        """
+        with self.condition:
+            while True:
+                self._release_due()
+                item = self._pop()
+                if item is None and self.spilled:
+                    self._refill()
+                    item = self._pop()
+                if item is not None:
+                    return item
+                if not self.in_flight and not self.delayed:
+                    return None
+                if not block:
+                    raise Empty
+                self.condition.wait(max(self.delayed[0][0] - time.monotonic(), 0) if self.delayed else None)
+
+    def defer(self, url, depth, delay, attempt=True):
+        """ Hand url out again at depth after delay seconds, call on a URL in flight before its task_done
+
+        attempt counts the deferral towards attempts(url), leave it out for URLs deferred without being tried.
+        """
+        with self.condition:
+            if attempt:
+                self.deferrals[url] = self.deferrals.get(url, 0) + 1
+            self.deferred[url] = depth
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.order), url, depth))
+
+    def attempts(self, url):
+        """ Times url was deferred so far """
+        with self.condition:
+            return self.deferrals.get(url, 0)
+
+    def task_done(self, url):
+        """ Mark a URL returned by get() as processed """
+        with self.condition:
+            self.in_flight[url].pop()
+            if not self.in_flight[url]:
+                del self.in_flight[url]
+                if url not in self.deferred:
+                    self.deferrals.pop(url, None)
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.queued)
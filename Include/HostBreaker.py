@@ -0,0 +1,46 @@
+from threading import Lock
+
+
+class HostBreaker:
+    """ Thread-safe circuit breaker giving up on hosts that fail to connect threshold times in a row
+
+    Any response from a host resets its count. Once a host is given up on, it stays so for the crawl
+    and dead(host) returns the error that tripped it.
+    """
+
+    def __init__(self, threshold=3):
+        self.threshold = threshold
+        self.lock = Lock()
+        self.failures = {}  # host -> consecutive connection failures
+        self.errors = {}  # host given up on -> its last error
+
+    def dead(self, host):
+        """ The error a host was given up on after, or None if it is still checked """
+        if self.threshold <= 0:
+            return None
+        return self.errors.get(host)
+
+    def failure(self, host, error):
+        """ Count a failed connection to host, returns True if this failure made the host dead """
+        if self.threshold <= 0:
+            return False
+        with self.lock:
+            if host in self.errors:
+                return False
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] < self.threshold:
+                return False
+            self.errors[host] = str(error)
+            return True
+
+    def success(self, host):
+        """ host answered, its failures so far were not in a row """
+        if host in self.failures:
+            with self.lock:
+                self.failures.pop(host, None)
+
+    def __len__(self):
+        return len(self.errors)
+
+    def __str__(self):
+        return "%d hosts given up on" % len(self.errors)
@@ -0,0 +1,98 @@
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+from threading import BoundedSemaphore, Lock
+import time
+
+
+class HostLimiter:
+    """ Per-host token bucket rate limit and concurrency cap, unrelated hosts never wait on each other
+
+    A host can also be paused, e.g. for the Retry-After of a 429 response, whatever its rate.
+    """
+
+    def __init__(self, rate=0, max_concurrent=0, burst=1):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.max_concurrent = max_concurrent
+        self.burst = max(burst, 1)
+        self.lock = Lock()
+        self.next_free = {}  # host -> time the bucket is next empty
+        self.paused_until = {}  # host -> time requests may resume
+        self.slots = {}
+        self.async_slots = {}
+
+    def reserve(self, host):
+        """ Take a token for host, returns the seconds to wait before using it """
+        if not self.interval and not self.paused_until:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            resume = self.paused_until.get(host, now)
+            if resume <= now:
+                self.paused_until.pop(host, None)
+                resume = now
+            if not self.interval:
+                return resume - now
+            next_free = max(self.next_free.get(host, now), resume)
+            self.next_free[host] = next_free + self.interval
+            return max(next_free - now - (self.burst - 1) * self.interval, 0)
+
+    def paused(self, host):
+        """ Seconds left of host's pause, 0 if it isn't paused """
+        with self.lock:
+            return max(self.paused_until.get(host, 0) - time.monotonic(), 0)
+
+    def pause(self, host, seconds):
+        """ Hold back requests to host for seconds, a pause already longer is kept """
+        with self.lock:
+            self.paused_until[host] = max(self.paused_until.get(host, 0), time.monotonic() + seconds)
+
+    def _slot(self, host):
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = BoundedSemaphore(self.max_concurrent)
+            return self.slots[host]
+
+    @contextmanager
+    def limit(self, host):
+        """ Sleep until the bucket allows a request, then hold one of host's concurrent slots
+
+        The slot is only taken once the wait is over, so a sleeping request never keeps another from running.
+        """
+        slot = self._slot(host) if self.max_concurrent > 0 else None
+        while True:
+            delay = self.reserve(host)
+            if delay:
+                time.sleep(delay)
+            if slot is None:
+                break
+            slot.acquire()
+            if not self.paused(host):
+                break
+            slot.release()  # Paused while waiting for the slot, wait out the pause first
+        try:
+            yield
+        finally:
+            if slot is not None:
+                slot.release()
+
+    @asynccontextmanager
+    async def async_limit(self, host):
+        """ Event loop version of limit(), must always be used from the same loop """
+        slot = None
+        if self.max_concurrent > 0:
+            slot = self.async_slots.setdefault(host, asyncio.Semaphore(self.max_concurrent))
+        while True:
+            delay = self.reserve(host)
+            if delay:
+                await asyncio.sleep(delay)
+            if slot is None:
+                break
+            await slot.acquire()
+            if not self.paused(host):
+                break
+            slot.release()
+        try:
+            yield
+        finally:
+            if slot is not None:
+                slot.release()
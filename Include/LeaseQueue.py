@@ -0,0 +1,106 @@
+import logging
+from queue import Empty
+from threading import Event, Lock
+import time
+
+
+class LeaseQueue:
+    """ Hands out the URLs of a Frontier to remote workers as leases
+
+    A worker claims (url, depth) leases and reports each result back, which record(url, depth, result)
+    stores, returning the (url, depth) children to queue. Leases not reported within lease_seconds
+    are requeued for another worker, and a URL whose lease expires max_attempts times is passed to
+    abandon(url, depth) instead. leased(url), if given, is called as each lease is handed out.
+    finished is set once the frontier is empty with no lease out.
+    """
+
+    def __init__(self, frontier, record, abandon, lease_seconds=300, max_attempts=3, settings=None, leased=None):
+        self.frontier = frontier
+        self.record = record
+        self.abandon = abandon
+        self.leased = leased
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.settings = settings or {}
+        self.leases = {}  # url -> (depth, worker, deadline)
+        self.attempts = {}  # url -> leases that expired
+        self.lock = Lock()
+        self.finished = Event()
+
+    def get_settings(self):
+        """ Crawl settings every worker needs to match the coordinator """
+        return self.settings
+
+    def claim(self, worker, count=1):
+        """ Lease up to count (url, depth) to worker, an empty list means retry later and None that the crawl is over """
+        self.expire()
+        items = []
+        with self.lock:
+            while len(items) < count:
+                try:
+                    item = self.frontier.get(block=False)
+                except Empty:
+                    break
+                if item is None:
+                    self.finished.set()
+                    return items or None
+                self.leases[item[0]] = (item[1], worker, time.monotonic() + self.lease_seconds)
+                items.append(item)
+        if self.leased is not None:
+            for url, _ in items:
+                self.leased(url)
+        return items
+
+    def report(self, worker, url, result):
+        """ Record the result of a lease, results of leases already handed to another worker are still recorded """
+        with self.lock:
+            lease = self.leases.get(url)
+            owned = lease is not None and lease[1] == worker
+            if owned:
+                del self.leases[url]
+                self.attempts.pop(url, None)
+        if lease is None:
+            logging.warning("%s reported %s without holding its lease." % (worker, url))
+            return
+
+        try:
+            for child, depth in self.record(url, lease[0], result):
+                self.frontier.put(child, depth)
+        finally:
+            if owned:
+                self.frontier.task_done(url)
+
+    def defer(self, worker, url, delay):
+        """ Give back a lease unchecked, to be handed out again after delay seconds, e.g. while its host is paused """
+        with self.lock:
+            lease = self.leases.get(url)
+            if lease is None or lease[1] != worker:
+                return
+            del self.leases[url]
+        self.frontier.defer(url, lease[0], delay, attempt=False)
+        self.frontier.task_done(url)
+
+    def expire(self):
+        """ Requeue leases past their deadline, abandoning URLs that expired max_attempts times """
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for url, (depth, worker, deadline) in list(self.leases.items()):
+                if deadline < now:
+                    del self.leases[url]
+                    self.attempts[url] = self.attempts.get(url, 0) + 1
+                    expired.append((url, depth, worker, self.attempts[url]))
+
+        for url, depth, worker, attempts in expired:
+            if attempts >= self.max_attempts:
+                logging.error("Lease on %s expired %d times, giving up." % (url, attempts))
+                self.abandon(url, depth)
+                self.frontier.task_done(url)
+            else:
+                logging.warning("Lease on %s held by %s expired, requeuing." % (url, worker))
+                self.frontier.task_done(url)
+                self.frontier.put(url, depth)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.leases)
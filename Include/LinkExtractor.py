@@ -0,0 +1,128 @@
+import codecs
+from html.parser import HTMLParser
+import logging
+import time
+
+from bs4 import BeautifulSoup
+
+
+class HrefParser(HTMLParser):
+    """ Streaming parser collecting the href of every <a> tag without building a tree """
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.hrefs = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        href = None
+        for name, value in attrs:
+            if name == "href":
+                # Like BeautifulSoup, the last of repeated attributes wins and a bare href is empty
+                href = "" if value is None else value
+        if href is not None:
+            self.hrefs.append(href)
+
+
+def soup_hrefs(content):
+    """ href of every <a> tag, found through a full BeautifulSoup tree """
+    soup = BeautifulSoup(content, "html.parser")
+    return [a["href"] for a in soup.find_all("a", href=True)]
+
+
+def stream_hrefs(content):
+    """ href of every <a> tag, found with HrefParser """
+    parser = HrefParser()
+    parser.feed(content)
+    parser.close()
+    return parser.hrefs
+
+
+EXTRACTORS = {
+    "stream": stream_hrefs,
+    "bs4": soup_hrefs,
+}
+
+
+def extract_hrefs(content, extractor="stream"):
+    """ Extract hrefs with the named extractor, falling back to BeautifulSoup if it fails """
+    try:
+        return EXTRACTORS[extractor](content)
+    except Exception as e:
+        if extractor == "bs4":
+            raise
+        logging.warning("%s extractor failed, falling back to bs4: %s" % (extractor, e))
+        return soup_hrefs(content)
+
+
+class PageReader:
+    """ Decodes a page arriving as byte chunks, reading at most max_bytes
+
+    With the stream extractor each chunk is fed to an HrefParser as soon as it is
+    decoded, so the page is never held in full. With any other extractor, or none,
+    the decoded text is kept and handed over once the page has been read.
+    """
+
+    def __init__(self, encoding=None, max_bytes=0, extractor="stream"):
+        try:
+            decoder = codecs.getincrementaldecoder(encoding or "utf-8")
+        except LookupError:
+            decoder = codecs.getincrementaldecoder("utf-8")
+        self.decoder = decoder(errors="replace")
+        self.max_bytes = max_bytes
+        self.extractor = extractor
+        self.parser = HrefParser() if extractor == "stream" else None
+        self.hrefs = []  # Found by the stream extractor before it failed, if it did
+        self.chunks = []
+        self.size = 0
+        self.truncated = False
+        self.seconds = 0.0  # Spent decoding and parsing, as opposed to waiting for chunks
+
+    def feed(self, data):
+        """ Read the next chunk, returns False once max_bytes is reached and the rest of the page should be skipped """
+        if self.max_bytes and self.size + len(data) > self.max_bytes:
+            data = data[:self.max_bytes - self.size]
+            self.truncated = True
+        self.size += len(data)
+        start = time.perf_counter()
+        self._feed_text(self.decoder.decode(data))
+        self.seconds += time.perf_counter() - start
+        return not self.truncated
+
+    def _feed_text(self, text):
+        if self.parser is not None:
+            try:
+                self.parser.feed(text)
+                return
+            except Exception as e:
+                logging.warning("stream extractor failed, falling back to bs4 for the rest of the page: %s" % e)
+                self._fall_back()
+        self.chunks.append(text)
+
+    def _fall_back(self):
+        self.hrefs = self.parser.hrefs
+        self.parser = None
+        self.extractor = "bs4"
+
+    @property
+    def text(self):
+        return "".join(self.chunks)
+
+    def close(self):
+        """ Finish decoding, returns the hrefs found or None if the reader was given no extractor """
+        start = time.perf_counter()
+        try:
+            self._feed_text(self.decoder.decode(b"", final=True))
+            if self.parser is not None:
+                try:
+                    self.parser.close()
+                    return self.parser.hrefs
+                except Exception as e:
+                    logging.warning("stream extractor failed, falling back to bs4 for the rest of the page: %s" % e)
+                    self._fall_back()
+            if self.extractor is None:
+                return None
+            return self.hrefs + extract_hrefs(self.text, self.extractor)
+        finally:
+            self.seconds += time.perf_counter() - start
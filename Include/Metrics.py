@@ -0,0 +1,202 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+from threading import Event, Lock, Thread
+import time
+
+# Upper bounds in seconds, wide enough for both a parse of a small page and a slow fetch
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """ Counts of observed values in fixed buckets, with their sum, min and max """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last count is for values past the largest bucket
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q quantile, or max if it is past the largest bucket """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def to_dict(self):
+        return {
+            "count": self.count, "sum": self.sum, "min": self.min, "max": self.max, "mean": self.mean,
+            "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99),
+            "buckets": {str(bound): count for bound, count in zip(self.buckets + ("+Inf",), self.counts)},
+        }
+
+
+class Metrics:
+    """ Thread-safe counters, gauges and histograms of a crawl, each optionally split by one label such as a host
+
+    label_names maps a metric to the name its label is given in the Prometheus output, "label" by default.
+    """
+
+    def __init__(self, prefix="link_checker", label_names=None):
+        self.prefix = prefix
+        self.label_names = label_names or {}
+        self.lock = Lock()
+        self.start = time.monotonic()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def count(self, name, value=1, label=None):
+        """ Add value to a counter """
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[label] = series.get(label, 0) + value
+
+    def gauge(self, name, value, label=None):
+        """ Set a gauge to its current value """
+        with self.lock:
+            self.gauges.setdefault(name, {})[label] = value
+
+    def observe(self, name, value, label=None):
+        """ Add a value, usually a duration in seconds, to a histogram """
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if label not in series:
+                series[label] = Histogram()
+            series[label].observe(value)
+
+    @contextmanager
+    def timer(self, name, label=None):
+        """ Observe the seconds spent in the with block """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, label)
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def total(self, name):
+        """ Sum of a counter over all labels """
+        with self.lock:
+            return sum(self.counters.get(name, {}).values())
+
+    def summary(self, name):
+        """ Histogram of name merged over all labels """
+        merged = Histogram()
+        with self.lock:
+            for histogram in self.histograms.get(name, {}).values():
+                merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+                merged.count += histogram.count
+                merged.sum += histogram.sum
+                merged.min = histogram.min if merged.min is None else min(merged.min, histogram.min)
+                merged.max = histogram.max if merged.max is None else max(merged.max, histogram.max)
+        return merged
+
+    def reset(self):
+        with self.lock:
+            self.start = time.monotonic()
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "elapsed_seconds": self.elapsed,
+                "counters": {name: _by_label(series) for name, series in self.counters.items()},
+                "gauges": {name: _by_label(series) for name, series in self.gauges.items()},
+                "histograms": {name: _by_label({label: h.to_dict() for label, h in series.items()})
+                               for name, series in self.histograms.items()},
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self):
+        """ Prometheus text exposition format """
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                metric = "%s_%s_total" % (self.prefix, name)
+                label_name = self.label_names.get(name, "label")
+                lines.append("# TYPE %s counter" % metric)
+                lines.extend("%s%s %s" % (metric, _labels(label_name, label), value) for label, value in _sorted(series))
+            for name, series in sorted(self.gauges.items()):
+                metric = "%s_%s" % (self.prefix, name)
+                label_name = self.label_names.get(name, "label")
+                lines.append("# TYPE %s gauge" % metric)
+                lines.extend("%s%s %s" % (metric, _labels(label_name, label), value) for label, value in _sorted(series))
+            for name, series in sorted(self.histograms.items()):
+                metric = "%s_%s" % (self.prefix, name)
+                label_name = self.label_names.get(name, "label")
+                lines.append("# TYPE %s histogram" % metric)
+                for label, histogram in _sorted(series):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append("%s_bucket%s %d" % (metric, _labels(label_name, label, le=bound), cumulative))
+                    lines.append("%s_sum%s %s" % (metric, _labels(label_name, label), histogram.sum))
+                    lines.append("%s_count%s %d" % (metric, _labels(label_name, label), histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+class Reporter(Thread):
+    """ Calls report() every interval seconds until stopped """
+
+    def __init__(self, interval, report):
+        Thread.__init__(self)
+        self.interval = interval
+        self.report = report
+        self.stopped = Event()
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def _by_label(series):
+    # Unlabelled series are reported as a plain value
+    if list(series) == [None]:
+        return series[None]
+    return {str(label): value for label, value in series.items()}
+
+
+def _sorted(series):
+    return sorted(series.items(), key=lambda item: "" if item[0] is None else str(item[0]))
+
+
+def _labels(label_name, label, le=None):
+    pairs = []
+    if label is not None:
+        pairs.append('%s="%s"' % (label_name, str(label).replace("\\", "\\\\").replace('"', '\\"')))
+    if le is not None:
+        pairs.append('le="%s"' % le)
+    return "{%s}" % ",".join(pairs) if pairs else ""
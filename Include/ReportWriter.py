@@ -0,0 +1,72 @@
+import csv
+import html
+import json
+
+
+class HtmlReport:
+    """ Broken links grouped under their parent page, rows must arrive ordered by parent """
+
+    def __init__(self, f):
+        self.f = f
+        self.rows = 0
+        self.heading = None
+        f.write("<html>\n<head>\n<style>\n"
+                "    h1 { font-size: 1.2em; }\n"
+                "    li { vertical-align: top; max-width: 80vw; white-space: nowrap; overflow: hidden; text-overflow: ellipsis; }\n"
+                "    .status { display: inline-block; width: 30px; color: red; margin-right: 1em; text-align: right; }\n"
+                "    .notes { color: gray; margin-left: 1em; }\n"
+                "</style>\n</head>\n<body>\n<h1>Link_Checker Results</h1>\n")
+
+    def write(self, row):
+        if self.heading != row["parent"]:
+            if self.heading is not None:
+                self.f.write("</ul>\n")
+            self.f.write("<h2><a href='{url}' target='_blank'>{url}</a></h2>\n<ul>\n".format(url=html.escape(row["parent"])))
+            self.heading = row["parent"]
+        notes = "<span class='notes'>%s</span>" % html.escape(row["notes"]) if row["notes"] else ""
+        self.f.write("<li><span class='status'>{status}</span><a href='{url}' target='_blank'>{url}</a>{notes}</li>\n".format(
+            url=html.escape(row["child"]), status=row["status"], notes=notes))
+        self.rows += 1
+
+    def close(self):
+        if self.heading is not None:
+            self.f.write("</ul>\n")  # Close final list
+        else:
+            self.f.write("<p>No bad links found</p>\n")
+        self.f.write("</body>\n</html>\n")
+
+
+class CsvReport:
+    """ One broken link per row, with a header row """
+
+    columns = ("parent", "child", "status", "count", "notes")
+
+    def __init__(self, f):
+        self.writer = csv.writer(f)
+        self.writer.writerow(self.columns)
+        self.rows = 0
+
+    def write(self, row):
+        self.writer.writerow([row[column] for column in self.columns])
+        self.rows += 1
+
+    def close(self):
+        return
+
+
+class JsonLinesReport:
+    """ One JSON object per broken link """
+
+    def __init__(self, f):
+        self.f = f
+        self.rows = 0
+
+    def write(self, row):
+        self.f.write(json.dumps({column: row[column] for column in CsvReport.columns}) + "\n")
+        self.rows += 1
+
+    def close(self):
+        return
+
+
+REPORTS = {"html": HtmlReport, "csv": CsvReport, "jsonl": JsonLinesReport}
@@ -0,0 +1,58 @@
+import hashlib
+import math
+from threading import Lock
+
+
+class SeenFilter:
+    """ Bloom filter over URLs with a fixed memory budget, answers 'definitely new' or 'possibly seen' """
+
+    def __init__(self, memory_bytes, error_rate=0.01):
+        self.size = max(int(memory_bytes), 1) * 8  # bits
+        self.bits = bytearray(self.size // 8)
+        self.error_rate = error_rate
+        # Optimal hash count for the target false-positive rate, and the number of URLs that rate holds for
+        self.hashes = max(int(round(-math.log2(error_rate))), 1)
+        self.capacity = int(self.size * math.log(2) ** 2 / -math.log(error_rate))
+        self.count = 0
+        self.lock = Lock()
+
+    def _positions(self, url):
+        digest = hashlib.blake2b(url.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, url):
+        """ Add url, returns False if it was definitely not in the filter before """
+        positions = self._positions(url)
+        with self.lock:
+            seen = True
+            for p in positions:
+                mask = 1 << (p & 7)
+                if not self.bits[p >> 3] & mask:
+                    seen = False
+                    self.bits[p >> 3] |= mask
+            if not seen:
+                self.count += 1
+            return seen
+
+    def __contains__(self, url):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(url))
+
+    def clear(self):
+        with self.lock:
+            self.bits = bytearray(len(self.bits))
+            self.count = 0
+
+    @property
+    def false_positive_rate(self):
+        """ Expected false-positive rate at the current fill """
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+    def __len__(self):
+        return self.count
+
+    def __str__(self):
+        return "%d URLs in %.1f MB, %d hashes, sized for %d URLs at %.2f%%, now %.4f%% false positives" % (
+            self.count, len(self.bits) / 2 ** 20, self.hashes, self.capacity,
+            100 * self.error_rate, 100 * self.false_positive_rate)
@@ -0,0 +1,91 @@
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+class ConnectionStats:
+    """ Thread-safe counters of new versus reused HTTP connections """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def connection_created(self):
+        with self.lock:
+            self.new_connections += 1
+
+    def request_sent(self):
+        with self.lock:
+            self.requests += 1
+
+    @property
+    def reused_connections(self):
+        """ Every request that did not need a new connection went over a kept-alive one """
+        return max(self.requests - self.new_connections, 0)
+
+    def __str__(self):
+        return "%d requests, %d new connections, %d reused connections" % (
+            self.requests, self.new_connections, self.reused_connections)
+
+
+class SessionPool:
+    """ Keep-alive requests session shared by all worker threads """
+
+    def __init__(self, pool_size, headers=None, stats=None, drain_limit=64 * 1024):
+        self.stats = ConnectionStats() if stats is None else stats
+        self.drain_limit = drain_limit  # Largest unread body read off the socket to keep its connection open
+        self.session = requests.Session()
+        if headers:
+            self.session.headers.update(headers)
+
+        # pool_connections is the number of hosts kept, pool_maxsize the open connections per host
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        adapter.poolmanager.pool_classes_by_scheme = {
+            "http": self._counting_pool(HTTPConnectionPool),
+            "https": self._counting_pool(HTTPSConnectionPool),
+        }
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _counting_pool(self, base):
+        """ Subclass a urllib3 pool so it reports connections and requests to self.stats """
+        stats = self.stats
+
+        # A pooled connection that was closed is opened again by connect, without going through the pool's _new_conn
+        class CountingConnection(base.ConnectionCls):
+            def connect(self):
+                stats.connection_created()
+                return super().connect()
+
+        class CountingPool(base):
+            ConnectionCls = CountingConnection
+
+            def _make_request(self, *args, **kwargs):
+                stats.request_sent()
+                return super()._make_request(*args, **kwargs)
+
+        return CountingPool
+
+    def get(self, url, **kwargs):
+        """ GET url over a pooled connection """
+        return self.session.get(url, **kwargs)
+
+    def head(self, url, **kwargs):
+        """ HEAD url over a pooled connection """
+        return self.session.head(url, **kwargs)
+
+    def drain(self, response):
+        """ Read the rest of a small streamed body, so closing the response returns its connection to the pool """
+        if isinstance(response, requests.Response) and not response.raw.closed:
+            try:
+                if int(response.headers.get("content-length", self.drain_limit + 1)) <= self.drain_limit:
+                    response.content
+            except (ValueError, RuntimeError, requests.RequestException):
+                pass  # Closing the response drops the connection instead
+
+    def close(self):
+        """ Close all pooled connections """
+        self.session.close()
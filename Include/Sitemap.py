@@ -0,0 +1,56 @@
+from datetime import datetime, timezone
+import gzip
+from io import BytesIO
+import xml.etree.ElementTree as ElementTree
+
+
+def parse_lastmod(value):
+    """ Unix time of a W3C datetime such as 2019-10-01 or 2019-10-01T12:00:00+00:00, or None if it can't be read """
+    try:
+        moment = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)  # Dates without a time zone are taken as UTC
+    return moment.timestamp()
+
+
+class Sitemap:
+    """ Last modification times of the URLs listed in sitemap.xml files and sitemap indexes """
+
+    def __init__(self):
+        self.lastmod = {}  # url -> unix time, or None for URLs listed without a lastmod
+
+    def parse(self, content):
+        """ Read a sitemap or sitemap index, gzipped or not, returns the sitemaps an index lists """
+        if content[:2] == b"\x1f\x8b":
+            content = gzip.decompress(content)
+
+        sitemaps = []
+        loc = lastmod = None
+        # Elements are dropped once read, so large sitemaps are never held as a tree
+        for _, element in ElementTree.iterparse(BytesIO(content)):
+            tag = element.tag.rpartition("}")[2]
+            if tag == "loc":
+                loc = (element.text or "").strip()
+            elif tag == "lastmod":
+                lastmod = parse_lastmod(element.text or "")
+            elif tag in ("url", "sitemap"):
+                if loc:
+                    if tag == "url":
+                        self.lastmod[loc] = lastmod
+                    else:
+                        sitemaps.append(loc)
+                loc = lastmod = None
+                element.clear()
+        return sitemaps
+
+    def get(self, url):
+        """ lastmod of url as unix time, or None if it is unknown """
+        return self.lastmod.get(url)
+
+    def __contains__(self, url):
+        return url in self.lastmod
+
+    def __len__(self):
+        return len(self.lastmod)
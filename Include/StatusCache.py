@@ -0,0 +1,91 @@
+import sqlite3
+from threading import Lock
+import time
+
+
+class StatusCache:
+    """ Persistent per-URL check results, kept between crawls for revalidation """
+
+    def __init__(self, filename, ttl, commit_every=100):
+        self.ttl = ttl
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS status_cache (url TEXT PRIMARY KEY, status INTEGER, checked REAL, etag TEXT, last_modified TEXT) WITHOUT ROWID;
+            ''')
+        self.conn.commit()
+
+    def get(self, url):
+        """ Return (status, checked, etag, last_modified) for url, or None """
+        with self.lock:
+            return self.conn.execute(
+                'SELECT status, checked, etag, last_modified FROM status_cache WHERE url=?;', [url]).fetchone()
+
+    def lookup(self, url):
+        """ Return (fresh status or None, conditional request headers) and count the outcome """
+        entry = self.get(url)
+        if entry is None:
+            self._count("misses")
+            return None, {}
+
+        status, checked, etag, last_modified = entry
+        if time.time() - checked < self.ttl:
+            self._count("hits")
+            return status, {}
+
+        headers = self._conditional_headers(etag, last_modified)
+        if not headers:
+            self._count("misses")
+        return None, headers
+
+    def validators(self, url):
+        """ Return conditional request headers for url however fresh its entry, for pages whose content is needed """
+        entry = self.get(url)
+        if entry is None:
+            return {}
+        return self._conditional_headers(entry[2], entry[3])
+
+    def _conditional_headers(self, etag, last_modified):
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def put(self, url, status, etag=None, last_modified=None):
+        """ Record a fresh check of url """
+        self._write('INSERT OR REPLACE INTO status_cache (url, status, checked, etag, last_modified) VALUES (?, ?, ?, ?, ?);',
+                    [url, status, time.time(), etag, last_modified])
+
+    def touch(self, url):
+        """ Mark url as checked now without changing its result, e.g. after a 304 Not Modified """
+        self._count("revalidated")
+        self._write('UPDATE status_cache SET checked=? WHERE url=?;', [time.time(), url])
+
+    def _count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _write(self, sql, params):
+        with self.lock:
+            self.conn.execute(sql, params)
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def __str__(self):
+        return "%d fresh hits, %d revalidated, %d misses" % (self.hits, self.revalidated, self.misses)
@@ -0,0 +1,51 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class UrlCache:
+    """ Bounded, thread-safe LRU map of URL to url_id """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url):
+        """ Return the cached url_id for url, or None """
+        with self.lock:
+            url_id = self.entries.get(url)
+            if url_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(url)
+            return url_id
+
+    def put(self, url, url_id):
+        """ Cache url_id for url, evicting the least recently used entry when full """
+        if self.capacity <= 0 or url_id is None:
+            return
+        with self.lock:
+            self.entries[url] = url_id
+            self.entries.move_to_end(url)
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def warm(self, rows):
+        """ Load (url, url_id) rows, e.g. from the url table of a resumed crawl """
+        for url, url_id in rows:
+            self.put(url, url_id)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        total = self.hits + self.misses
+        return "%d entries, %d hits, %d misses (%.1f%% hit rate)" % (
+            len(self.entries), self.hits, self.misses, 100.0 * self.hits / total if total else 0)
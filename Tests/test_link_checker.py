@@ -1,9 +1,31 @@
+import argparse
 from contextlib import closing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from Include.ConcurrencyController import ConcurrencyController
+from Include.DbWriter import DbWriter
+from Include.DnsCache import DnsCache
+from Include.Frontier import Frontier
+from Include.HostBreaker import HostBreaker
+from Include.HostLimiter import HostLimiter
+from Include.LeaseQueue import LeaseQueue
+from Include.LinkExtractor import PageReader, soup_hrefs, stream_hrefs
+from Include.Metrics import Metrics
+from Include.ReportWriter import REPORTS
+from Include.SeenFilter import SeenFilter
+from Include.SessionPool import SessionPool
+from Include.Sitemap import Sitemap
+from Include.StatusCache import StatusCache
+from Include.UrlCache import UrlCache
 import link_checker
 import logging
+import io
+import json
 import random
 import requests
+import socket
 import sqlite3
+import threading
+import time
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -20,16 +42,42 @@ def main():
     unit_initialize_db()
     unit_add_url_to_db()
     unit_add_link()
+    unit_compact_db()
+    unit_db_writer()
+    unit_db_writer_stopped()
+    unit_error_statuses()
     unit_get_error_urls()
     unit_get_urls()
+    unit_insert_url()
+    unit_mark_in_flight()
     unit_process_url()
     unit_process_url_no_parse()
+    unit_update_links()
     unit_update_url_status()
 
     # Utility methods
+    unit_canonicalize_url()
+    unit_classify_error()
+    unit_concurrency_controller()
+    unit_dns_cache()
+    unit_frontier()
     unit_get_header()
     unit_get_page()
+    unit_host_breaker()
+    unit_host_limiter()
+    unit_lease_queue()
+    unit_metrics()
+    unit_page_reader()
     unit_parse_content()
+    unit_report_writer()
+    unit_retry_or_keep()
+    unit_retry_status_cache()
+    unit_seen_filter()
+    unit_session_pool()
+    unit_sitemap()
+    unit_extract_hrefs()
+    unit_status_cache()
+    unit_url_cache()
     unit_validate_url()
 
 def unit_add_link():
@@ -78,6 +126,283 @@ def unit_add_url_to_db():
     
     logging.info("***** unit_add_url_to_db complete *****")
 
+def unit_canonicalize_url():
+    logging.info("***** unit_canonicalize_url starting *****")
+    base = "https://www.sos.wa.gov/library/default.aspx"
+    expected = (
+        ("libraries/", True, None, "https://www.sos.wa.gov/library/libraries/"),
+        ("HTTPS://WWW.SOS.WA.GOV:443/library#contact", True, None, "https://www.sos.wa.gov/library"),
+        ("http://sos.wa.gov:8080", True, None, "http://sos.wa.gov:8080/"),
+        ("search?testquery=5&testanswer=5", True, None, "https://www.sos.wa.gov/library/search?testquery=5&testanswer=5"),
+        ("search?testquery=5&testanswer=5", False, None, "https://www.sos.wa.gov/library/search"),
+        ("search?testquery=5&testanswer=5", True, ("testanswer",), "https://www.sos.wa.gov/library/search?testanswer=5"),
+        ("mailto:library@sos.wa.gov", True, None, None),
+        ("http://localhost:[903]", True, None, None),
+        )
+
+    for href, use_queries, keys, url in expected:
+        try:
+            assert lc.canonicalize_url(base, href, use_queries, keys) == url
+        except AssertionError as ex:
+            logging.error("unit_canonicalize_url failed - %s gave %s, expected %s" % (href, lc.canonicalize_url(base, href, use_queries, keys), url))
+            logging.debug(ex)
+
+    logging.info("***** unit_canonicalize_url complete *****")
+
+def unit_classify_error():
+    logging.info("***** unit_classify_error starting *****")
+    # Failures the way requests raises them, wrapping urllib3 errors that wrap the socket error
+    def wrapped(cause):
+        try:
+            try:
+                raise cause
+            except OSError as e:
+                raise requests.urllib3.exceptions.NewConnectionError(None, "Failed to establish a new connection: %s" % e)
+        except requests.urllib3.exceptions.NewConnectionError as e:
+            return requests.exceptions.ConnectionError(requests.urllib3.exceptions.MaxRetryError(None, test_url, e))
+
+    try:
+        assert lc.classify_error(wrapped(socket.gaierror(-2, "Name or service not known"))) == "dns"
+        assert lc.classify_error(wrapped(ConnectionRefusedError(111, "Connection refused"))) == "connect"
+        assert lc.classify_error(requests.exceptions.ReadTimeout("Read timed out.")) == "timeout"
+        assert lc.classify_error(requests.exceptions.SSLError("certificate verify failed")) == "tls"
+        assert lc.classify_error(requests.exceptions.ConnectionError(
+            requests.urllib3.exceptions.ProtocolError("Connection aborted.", ConnectionResetError(104, "reset")))) == "reset"
+        assert lc.classify_error(ValueError("bad")) == "error"
+        logging.info("unit_classify_error passed - failures classified by their cause.")
+    except AssertionError as ex:
+        logging.error("unit_classify_error failed - unexpected class.")
+        logging.debug(ex)
+
+    logging.info("***** unit_classify_error complete *****")
+
+def unit_compact_db():
+    logging.info("***** unit_compact_db starting *****")
+    lc.initialize_db(True, compact=True)
+    hash_url = lc.hash_url
+    lc.hash_url = lambda url: 0  # Every URL shares a hash, so only the URL text tells them apart
+
+    try:
+        assert lc.compact_db
+        first = lc.add_url_to_db(test_url + "a", 1)
+        second = lc.add_url_to_db(test_url + "b", 1)
+        assert first != second and lc.add_url_to_db(test_url + "a", 1) == first
+        lc.mark_in_flight(test_url + "b")
+        lc.add_links(first, {second: 2}.items())
+        lc.update_url_status(second, 404, 0)
+        assert [tuple(row) for row in lc.get_error_urls()] == [(test_url + "a", test_url + "b", 2, 404, None)]
+
+        # A link the seen filter takes as new may have been added by another thread since, it is still looked up
+        lc.seen_filter = SeenFilter(2 ** 16, 0.01)
+        assert lc.insert_url(test_url + "a", 1) == (first, False)
+        with closing(lc.get_connection()) as conn:
+            assert conn.execute('SELECT COUNT(*) FROM url WHERE url=?;', [test_url + "a"]).fetchone()[0] == 1
+
+        # Reopened, the database keeps its schema whatever is asked for
+        lc.initialize_db()
+        assert lc.compact_db and lc.insert_url(test_url + "b") == (second, False)
+        lc.initialize_db(True)
+        assert not lc.compact_db
+        logging.info("unit_compact_db passed - URLs found by hash and text.")
+    except AssertionError as ex:
+        logging.error("unit_compact_db failed - unexpected URL ids.")
+        logging.debug(ex)
+
+    lc.hash_url = hash_url
+    lc.seen_filter = None
+    logging.info("***** unit_compact_db complete *****")
+
+def unit_concurrency_controller():
+    logging.info("***** unit_concurrency_controller starting *****")
+    fixed = ConcurrencyController(2, 2)
+    controller = ConcurrencyController(2, 8, 4, interval=0)
+
+    try:
+        assert fixed.try_acquire() and fixed.try_acquire()
+        assert not fixed.try_acquire()
+        fixed.release()
+        assert fixed.try_acquire()
+
+        for _ in range(4):
+            assert controller.try_acquire()
+        assert not controller.try_acquire()  # Waiting for a slot lets the limit grow
+        controller.record(0.1, 200)
+        assert controller.limit == 8
+        controller.record(0.1, 429)  # Throttled requests halve it
+        assert controller.limit == 4
+        controller.record(0.5, 200)  # Latency rising past twice the best lowers it by one
+        assert controller.limit == 3
+        logging.info("unit_concurrency_controller passed - limit adapted as expected.")
+    except AssertionError as ex:
+        logging.error("unit_concurrency_controller failed - limit %s." % controller)
+        logging.debug(ex)
+
+    logging.info("***** unit_concurrency_controller complete *****")
+
+def unit_db_writer():
+    logging.info("***** unit_db_writer starting *****")
+    lc.initialize_db(True)
+
+    lc.db_writer = DbWriter(lc.db_name, batch_size=100, flush_interval=60)
+    try:
+        url_id = lc.add_url_to_db(test_url)
+        lc.update_url_status(url_id, 200, 1)
+        lc.db_writer.flush()
+
+        with closing(lc.get_connection()) as conn:
+            status = conn.execute('SELECT status FROM url WHERE url_id=?', [url_id]).fetchone()[0]
+        assert status == 200
+        logging.info("unit_db_writer passed - queued status committed on flush.")
+    except AssertionError as ex:
+        logging.error("unit_db_writer failed - status not committed on flush.")
+        logging.debug(ex)
+    finally:
+        lc.db_writer.close()
+        lc.db_writer = None
+
+    logging.info("***** unit_db_writer complete *****")
+
+def unit_db_writer_stopped():
+    logging.info("***** unit_db_writer_stopped starting *****")
+    lc.initialize_db(True)
+
+    writer = DbWriter(lc.db_name, batch_size=100, flush_interval=60)
+    try:
+        writer.execute(lambda conn: conn.close())  # The commit and rollback after it fail, stopping the thread
+        try:
+            writer.flush()
+            assert False
+        except Exception as ex:
+            assert not isinstance(ex, AssertionError)
+        writer.join(5)
+        assert not writer.is_alive()
+        try:
+            writer.submit(lambda conn: None)
+            assert False
+        except RuntimeError:
+            pass
+        logging.info("unit_db_writer_stopped passed - waiting callers get the error instead of hanging.")
+    except AssertionError as ex:
+        logging.error("unit_db_writer_stopped failed - writer failure not reported.")
+        logging.debug(ex)
+
+    logging.info("***** unit_db_writer_stopped complete *****")
+
+def unit_dns_cache():
+    logging.info("***** unit_dns_cache starting *****")
+    lookups = []
+
+    def resolve(host, port, *args):
+        lookups.append(host)
+        if host.endswith(".invalid"):
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", port))]
+
+    cache = DnsCache(60)
+    cache.resolve = resolve
+    try:
+        assert cache.getaddrinfo("example.com", 80) == cache.getaddrinfo("example.com", 80)
+        for _ in range(2):
+            try:
+                cache.getaddrinfo("nohost.invalid", 80)
+                assert False
+            except socket.gaierror:
+                pass
+        assert lookups == ["example.com", "nohost.invalid"]
+        assert cache.hits == 2 and cache.misses == 2
+
+        cache.ttl = 0
+        cache.getaddrinfo("example.com", 443)
+        cache.getaddrinfo("example.com", 443)
+        assert lookups.count("example.com") == 3  # Expired answers are looked up again
+        logging.info("unit_dns_cache passed - lookups and failed lookups reused.")
+    except AssertionError as ex:
+        logging.error("unit_dns_cache failed - unexpected lookups %s." % lookups)
+        logging.debug(ex)
+
+    logging.info("***** unit_dns_cache complete *****")
+
+def unit_error_statuses():
+    logging.info("***** unit_error_statuses starting *****")
+    lc.initialize_db(True)
+    parent = lc.add_url_to_db(test_url, 0)
+    statuses = {test_url + "ok": 200, test_url + "failed": 0, test_url + "skipped": lc.skipped_status}
+    for url, status in statuses.items():
+        url_id = lc.add_url_to_db(url, 1)
+        lc.add_link(parent, url_id)
+        lc.update_url_status(url_id, status, 0)
+
+    try:
+        # Failed requests and URLs on hosts given up on are both reported, and can be left out separately
+        assert sorted(row["status"] for row in lc.get_error_urls()) == [lc.skipped_status, 0]
+        assert [row["child"] for row in lc.get_error_urls([lc.skipped_status])] == [test_url + "failed"]
+        logging.info("unit_error_statuses passed - failed and skipped URLs told apart.")
+    except AssertionError as ex:
+        logging.error("unit_error_statuses failed - unexpected report rows.")
+        logging.debug(ex)
+
+    logging.info("***** unit_error_statuses complete *****")
+
+def unit_extract_hrefs():
+    logging.info("***** unit_extract_hrefs starting *****")
+    content = '''<html><body>
+        <a href="/library/">Library</a><A HREF='search?q=1&amp;r=2'>Search</A>
+        <a name="anchor">No href</a><a href>Empty</a><img src="/logo.png"/>
+        <a href="https://www.sos.wa.gov/library/#contact" />
+        </body></html>'''
+
+    try:
+        assert stream_hrefs(content) == soup_hrefs(content)
+        logging.info("unit_extract_hrefs passed - extractors agree: %s" % stream_hrefs(content))
+    except AssertionError as ex:
+        logging.error("unit_extract_hrefs failed - stream %s | bs4 %s" % (stream_hrefs(content), soup_hrefs(content)))
+        logging.debug(ex)
+
+    logging.info("***** unit_extract_hrefs complete *****")
+
+def unit_frontier():
+    logging.info("***** unit_frontier starting *****")
+    frontier = Frontier()
+    frontier.put(test_url + "deep", 3)
+    frontier.put(test_url + "shallow", 2)
+    frontier.put(test_url + "deep", 1)  # Found again closer to the start URL
+
+    try:
+        assert frontier.get() == (test_url + "deep", 1)
+        assert frontier.get() == (test_url + "shallow", 2)
+        frontier.task_done(test_url + "deep")
+        frontier.task_done(test_url + "shallow")
+        assert frontier.get() is None
+
+        # Past max_size URLs are left to the database and read back through refill
+        pending = [(test_url + "1", 1), (test_url + "2", 1)]
+        frontier = Frontier(max_size=1, refill=lambda limit: pending[:limit])
+        for url, depth in pending:
+            frontier.put(url, depth)
+        assert len(frontier) == 1
+        assert frontier.get() == pending[0]
+        assert frontier.get() == pending[1]
+
+        # A deferred URL is handed out again once its delay is over, and the frontier isn't empty meanwhile
+        frontier = Frontier()
+        frontier.put(test_url, 1)
+        frontier.get()
+        frontier.defer(test_url, 1, 0.2)
+        frontier.task_done(test_url)
+        frontier.put(test_url, 1)  # Not queued twice
+        assert frontier.attempts(test_url) == 1
+        assert 0 < frontier.next_due() <= 0.2
+        assert frontier.get() == (test_url, 1)
+        assert frontier.next_due() is None
+        frontier.task_done(test_url)
+        assert frontier.get() is None and frontier.attempts(test_url) == 0
+        logging.info("unit_frontier passed - URLs returned shallowest first, once each.")
+    except AssertionError as ex:
+        logging.error("unit_frontier failed - unexpected frontier order.")
+        logging.debug(ex)
+
+    logging.info("***** unit_frontier complete *****")
+
 def unit_get_error_urls():
     logging.info("***** unit_get_error_urls starting *****")
     lc.initialize_db(True)
@@ -88,21 +413,22 @@ def unit_get_error_urls():
     # Initialize urls, url should match child from get_error_urls
     for i in range(1, total_urls):
         url = test_url + str(i)
-        lc.add_url_to_db(url)
+        url_id = lc.add_url_to_db(url)
         r = random.randint(0, 1)
         status_code = 200
         if r:
             error_urls.append(url)
             status_code = 404
-        lc.update_url_status(url, status_code, 0)
-        lc.add_link(1, i)
+        lc.update_url_status(url_id, status_code, 0)
+        lc.add_link(1, url_id)
 
     try:
-        results = lc.get_error_urls()
+        results = list(lc.get_error_urls())
         error_urls.sort()
         if len(results) == len(error_urls):
             for i in range(len(results)):
                 assert error_urls[i] == results[i]['child']
+            logging.info("unit_get_error_urls passed - %d error URLs returned." % len(results))
         else:
             logging.critical("unit_get_error_urls failed: wrong number of rows returned. Expected %d, found %d." % (len(error_urls), len(results)))
     except AssertionError as ex:
@@ -129,6 +455,70 @@ def unit_get_urls():
     assert True
     logging.info("***** unit_get_urls complete *****")
 
+def unit_host_breaker():
+    logging.info("***** unit_host_breaker starting *****")
+    breaker = HostBreaker(3)
+    try:
+        assert not breaker.failure("a", "refused")
+        assert not breaker.failure("a", "refused")
+        breaker.success("a")  # Failures only count in a row
+        assert not breaker.failure("a", "refused")
+        assert not breaker.failure("a", "refused")
+        assert breaker.dead("a") is None
+        assert breaker.failure("a", "timed out")
+        assert breaker.dead("a") == "timed out"
+        assert not breaker.failure("a", "refused")  # Only reported dead once
+        assert breaker.dead("b") is None and len(breaker) == 1
+        assert HostBreaker(0).failure("a", "refused") is False
+        logging.info("unit_host_breaker passed - hosts given up on after failures in a row.")
+    except AssertionError as ex:
+        logging.error("unit_host_breaker failed - unexpected breaker state.")
+        logging.debug(ex)
+
+    logging.info("***** unit_host_breaker complete *****")
+
+def unit_host_limiter():
+    logging.info("***** unit_host_limiter starting *****")
+    limiter = HostLimiter(rate=2)
+
+    try:
+        assert limiter.reserve("a.example.com") == 0
+        assert limiter.reserve("a.example.com") > 0.4  # Second request to the same host waits ~0.5s
+        assert limiter.reserve("b.example.com") == 0  # Other hosts are not delayed
+
+        # A paused host waits out the pause even without a rate limit
+        limiter = HostLimiter()
+        limiter.pause("a.example.com", 30)
+        assert limiter.paused("a.example.com") > 29 and limiter.paused("b.example.com") == 0
+        assert limiter.reserve("a.example.com") > 29
+        assert limiter.reserve("b.example.com") == 0
+
+        # A request waiting out a pause leaves the host's slot to others, and a pause raised meanwhile is waited out
+        limiter = HostLimiter(max_concurrent=1)
+        limiter.pause("a.example.com", 0.3)
+        entered = []
+
+        def request():
+            with limiter.limit("a.example.com"):
+                entered.append(time.monotonic())
+
+        waiting = threading.Thread(target=request)
+        waiting.start()
+        time.sleep(0.1)
+        slot = limiter._slot("a.example.com")
+        assert slot.acquire(blocking=False)
+        limiter.pause("a.example.com", 0.5)
+        slot.release()
+        started = time.monotonic()
+        waiting.join()
+        assert entered and entered[0] - started > 0.4
+        logging.info("unit_host_limiter passed - only repeat requests to one host were delayed.")
+    except AssertionError as ex:
+        logging.error("unit_host_limiter failed - unexpected delay.")
+        logging.debug(ex)
+
+    logging.info("***** unit_host_limiter complete *****")
+
 def unit_initialize_db():
     logging.info("***** unit_initialize_db starting *****")
     try:
@@ -154,6 +544,148 @@ def unit_initialize_db():
         exit("Table selection failed.")
     logging.info("***** unit_initialize_db complete *****")
 
+def unit_insert_url():
+    logging.info("***** unit_insert_url starting *****")
+    lc.initialize_db(True)
+
+    url_id, created = lc.insert_url(test_url)
+    again_id, created_again = lc.insert_url(test_url + "#fragment")
+
+    try:
+        assert created and not created_again
+        assert url_id == again_id
+        logging.info("unit_insert_url passed - %s added once." % test_url)
+    except AssertionError as ex:
+        logging.error("unit_insert_url failed - ids %s/%s, created %s/%s." % (url_id, again_id, created, created_again))
+        logging.debug(ex)
+
+    logging.info("***** unit_insert_url complete *****")
+
+def unit_lease_queue():
+    logging.info("***** unit_lease_queue starting *****")
+    recorded = []
+    abandoned = []
+
+    def record(url, depth, result):
+        recorded.append((url, depth, result))
+        return [(test_url + "child", depth + 1)] if depth == 0 else []
+
+    frontier = Frontier()
+    frontier.put(test_url, 0)
+    queue = LeaseQueue(frontier, record, lambda url, depth: abandoned.append(url), lease_seconds=0, max_attempts=2)
+
+    try:
+        # A lease that is never reported goes to another worker, then is given up on
+        assert queue.claim("a") == [(test_url, 0)]
+        assert queue.claim("b") == [(test_url, 0)]
+        assert queue.claim("c") is None and queue.finished.is_set()
+        assert abandoned == [test_url]
+
+        frontier = Frontier()
+        frontier.put(test_url, 0)
+        queue = LeaseQueue(frontier, record, lambda url, depth: abandoned.append(url))
+        assert queue.claim("a", 5) == [(test_url, 0)]
+        assert queue.claim("b") == []  # Leased, but not finished
+        queue.report("a", test_url, 200)
+        assert recorded == [(test_url, 0, 200)]
+        assert queue.claim("b") == [(test_url + "child", 1)]
+        queue.defer("b", test_url + "child", 0)  # Given back unchecked, e.g. while its host is paused
+        assert len(queue) == 0 and frontier.attempts(test_url + "child") == 0
+        assert queue.claim("b") == [(test_url + "child", 1)]
+        queue.report("b", test_url + "child", 404)
+        assert len(queue) == 0
+        assert queue.claim("a") is None
+        logging.info("unit_lease_queue passed - leases reported, reclaimed and abandoned as expected.")
+    except AssertionError as ex:
+        logging.error("unit_lease_queue failed - unexpected lease.")
+        logging.debug(ex)
+
+    logging.info("***** unit_lease_queue complete *****")
+
+def unit_mark_in_flight():
+    logging.info("***** unit_mark_in_flight starting *****")
+    lc.initialize_db(True)
+    done_id = lc.add_url_to_db(test_url + "done", 1)
+    lc.add_url_to_db(test_url + "interrupted", 1)
+    lc.mark_in_flight(test_url + "interrupted")
+    lc.update_url_status(done_id, 200, 0)
+    lc.mark_in_flight(test_url + "done")  # Done URLs stay done
+
+    def states():
+        with closing(lc.get_connection()) as conn:
+            return dict(conn.execute('SELECT url, state FROM url;'))
+
+    try:
+        assert states() == {test_url + "done": lc.state_done, test_url + "interrupted": lc.state_in_flight}
+        lc.initialize_db()  # A restart makes interrupted URLs pending again
+        assert states() == {test_url + "done": lc.state_done, test_url + "interrupted": lc.state_pending}
+        assert list(lc.get_urls()) == [(test_url + "interrupted", 1)]
+        logging.info("unit_mark_in_flight passed - interrupted URLs resumed.")
+    except AssertionError as ex:
+        logging.error("unit_mark_in_flight failed - unexpected states %s." % states())
+        logging.debug(ex)
+
+    logging.info("***** unit_mark_in_flight complete *****")
+
+def unit_metrics():
+    logging.info("***** unit_metrics starting *****")
+    metrics = Metrics(label_names={"fetch_seconds": "host"})
+    for seconds in (0.002, 0.004, 0.2):
+        metrics.observe("fetch_seconds", seconds, "www.sos.wa.gov")
+    metrics.observe("fetch_seconds", 3, "example.com")
+    metrics.count("urls_checked", 3)
+    metrics.count("urls_checked")
+    with metrics.timer("parse_seconds"):
+        pass
+
+    try:
+        assert metrics.total("urls_checked") == 4
+        summary = metrics.summary("fetch_seconds")
+        assert summary.count == 4 and summary.max == 3 and summary.quantile(0.5) == 0.005
+        snapshot = metrics.to_dict()
+        assert snapshot["histograms"]["fetch_seconds"]["www.sos.wa.gov"]["count"] == 3
+        assert snapshot["histograms"]["parse_seconds"]["count"] == 1
+        prometheus = metrics.to_prometheus()
+        assert 'link_checker_fetch_seconds_bucket{host="www.sos.wa.gov",le="+Inf"} 3' in prometheus
+        assert "link_checker_urls_checked_total 4" in prometheus
+        logging.info("unit_metrics passed.")
+    except AssertionError as ex:
+        logging.error("unit_metrics failed - %s" % metrics.to_json())
+        logging.debug(ex)
+
+    logging.info("***** unit_metrics complete *****")
+
+def unit_page_reader():
+    logging.info("***** unit_page_reader starting *****")
+    content = "<html><body><a href='/caf\u00e9/'>Caf\u00e9</a><a href='/library/'>Library</a><a href='/last/'>Last</a></body></html>"
+    data = content.encode("utf-8")
+    chunks = [data[i:i + 7] for i in range(0, len(data), 7)]  # Splits tags and the two byte character
+
+    try:
+        for extractor in ("stream", "bs4"):
+            reader = PageReader("utf-8", 0, extractor)
+            assert all(reader.feed(chunk) for chunk in chunks)
+            assert reader.close() == stream_hrefs(content)
+            assert not reader.truncated
+
+        # Reading stops at max_bytes, leaving the links past it unseen
+        reader = PageReader("utf-8", data.index(b"/last/"), "stream")
+        assert not all(reader.feed(chunk) for chunk in chunks)
+        assert reader.close() == ["/caf\u00e9/", "/library/"]
+        assert reader.truncated and reader.size == data.index(b"/last/")
+
+        # Without an extractor the text is kept for the parser processes
+        reader = PageReader(None, 0, None)
+        for chunk in chunks:
+            reader.feed(chunk)
+        assert reader.close() is None and reader.text == content
+        logging.info("unit_page_reader passed - hrefs read from %d chunks." % len(chunks))
+    except AssertionError as ex:
+        logging.error("unit_page_reader failed.")
+        logging.debug(ex)
+
+    logging.info("***** unit_page_reader complete *****")
+
 def unit_parse_content():
     logging.info("***** unit_parse_content starting *****")
     headers = {
@@ -175,12 +707,305 @@ def unit_process_url_no_parse():
     assert True
     logging.info("***** unit_process_url_status complete *****")
 
+def unit_report_writer():
+    logging.info("***** unit_report_writer starting *****")
+    rows = [
+        {"parent": test_url, "child": test_url + "a'b", "count": 1, "status": 404, "notes": None},
+        {"parent": test_url, "child": test_url + "c", "count": 2, "status": 0, "notes": "Timed out"},
+    ]
+    outputs = {}
+    for name, report_class in REPORTS.items():
+        f = io.StringIO()
+        report = report_class(f)
+        for row in rows:
+            report.write(row)
+        report.close()
+        outputs[name] = f.getvalue()
+
+    try:
+        assert outputs["html"].count("<h2>") == 1
+        assert "a&#x27;b" in outputs["html"] and "Timed out" in outputs["html"]
+        assert outputs["csv"].splitlines()[0] == "parent,child,status,count,notes"
+        assert len(outputs["csv"].splitlines()) == 3
+        assert [json.loads(line)["status"] for line in outputs["jsonl"].splitlines()] == [404, 0]
+
+        f = io.StringIO()
+        REPORTS["html"](f).close()
+        assert "No bad links found" in f.getvalue()
+        logging.info("unit_report_writer passed - every format written.")
+    except AssertionError as ex:
+        logging.error("unit_report_writer failed - unexpected report.")
+        logging.debug(ex)
+
+    logging.info("***** unit_report_writer complete *****")
+
+def unit_retry_or_keep():
+    logging.info("***** unit_retry_or_keep starting *****")
+    lc.args = argparse.Namespace(retries=1, retry_delay=0.1)
+    lc.host_limiter = HostLimiter()
+    frontier = Frontier()
+    frontier.put(test_url, 0)
+    frontier.get()
+
+    try:
+        # Transient failures are deferred up to --retries times, then kept noting the attempts
+        assert lc.retry_or_keep(frontier, (test_url, 0, None, None, "timeout: Read timed out."), 0) is None
+        frontier.task_done(test_url)
+        assert frontier.get() == (test_url, 0)
+        assert lc.retry_or_keep(frontier, (test_url, 503, None, None, None), 0) == (test_url, 503, None, None, "HTTP 503 (2 attempts)")
+        frontier.task_done(test_url)
+
+        # Permanent failures and answers are kept at once
+        assert lc.retry_or_keep(frontier, (test_url, 0, None, None, "dns: Name or service not known"), 0)[1] == 0
+        assert lc.retry_or_keep(frontier, (test_url, 404, None, None, None), 0) == (test_url, 404, None, None, None)
+        assert frontier.get() is None
+
+        # A paused host is retried once its pause is over, URLs dispatched meanwhile wait without counting an attempt
+        lc.host_limiter.pause("www.sos.wa.gov", 30)
+        frontier = Frontier()
+        frontier.put(test_url, 0)
+        frontier.put(test_url + "next", 0)
+        frontier.get()
+        assert lc.retry_or_keep(frontier, (test_url, 429, None, None, None), 0) is None
+        frontier.task_done(test_url)
+        assert frontier.next_due() > 29
+        assert lc.defer_if_paused(frontier, *frontier.get())
+        assert frontier.attempts(test_url + "next") == 0 and len(frontier) == 0
+        logging.info("unit_retry_or_keep passed - only transient failures retried.")
+    except AssertionError as ex:
+        logging.error("unit_retry_or_keep failed - unexpected retry.")
+        logging.debug(ex)
+
+    lc.args = None
+    lc.host_limiter = None
+    logging.info("***** unit_retry_or_keep complete *****")
+
+def unit_retry_status_cache():
+    logging.info("***** unit_retry_status_cache starting *****")
+    # A server that is always unavailable, every retry of a link has to reach it
+    requests_seen = []
+
+    class Unavailable(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.path)
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            return
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Unavailable)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/down" % server.server_address[1]
+    lc.initialize_db(True)
+    lc.args = argparse.Namespace(
+        no_query=False, acceptable_keys=[], base=set(), incremental=False, head_first=False, depth=1,
+        connect_timeout=5, read_timeout=5, host_failures=3, host_rate=0, host_connections=0,
+        pool_size=2, user_agent="test", retries=2, retry_delay=0.01)
+    lc.status_cache = StatusCache("tests_cache.db", ttl=3600)
+    lc.status_cache.put(url + "ok", 200)
+    frontier = Frontier()
+    frontier.put(url, 1)
+
+    try:
+        item = frontier.get()
+        while item is not None:
+            lc.process_url(item[0], False, item[1], frontier)
+            frontier.task_done(item[0])
+            item = frontier.get()
+        with closing(lc.get_connection()) as conn:
+            assert conn.execute('SELECT status, notes FROM url WHERE url=?;', [url]).fetchone() == (503, "HTTP 503 (3 attempts)")
+        assert len(requests_seen) == 3
+        assert lc.status_cache.get(url) is None  # Transient statuses are not cached
+        assert lc.check_cache(url + "ok", False) == (200, {})
+        assert lc.check_cache(url + "ok", False, retry=True) == (None, {})
+        logging.info("unit_retry_status_cache passed - every attempt reached the server.")
+    except AssertionError as ex:
+        logging.error("unit_retry_status_cache failed - %d requests reached the server." % len(requests_seen))
+        logging.debug(ex)
+    finally:
+        lc.status_cache.close()
+        lc.status_cache = None
+        server.shutdown()
+
+    lc.args = None
+    lc.session_pool = lc.host_limiter = lc.host_breaker = None
+    logging.info("***** unit_retry_status_cache complete *****")
+
+def unit_seen_filter():
+    logging.info("***** unit_seen_filter starting *****")
+    seen = SeenFilter(memory_bytes=1024, error_rate=0.01)
+    urls = [test_url + str(i) for i in range(500)]
+
+    try:
+        collisions = sum(seen.add(url) for url in urls)  # New URLs only read as seen on a false positive
+        assert collisions < 10
+        assert all(url in seen for url in urls)  # No false negatives
+        false_positives = sum(test_url + "other" + str(i) in seen for i in range(1000))
+        assert false_positives < 50
+        logging.info("unit_seen_filter passed - %d false positives in 1000. %s" % (false_positives, seen))
+    except AssertionError as ex:
+        logging.error("unit_seen_filter failed - %s" % seen)
+        logging.debug(ex)
+
+    logging.info("***** unit_seen_filter complete *****")
+
+def unit_session_pool():
+    logging.info("***** unit_session_pool starting *****")
+    # Keep-alive server counting the connections it actually accepts
+    accepted = []
+
+    class Page(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            body = b"<html>" + b"x" * 1000 + b"</html>"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            return
+
+    class CountingServer(ThreadingHTTPServer):
+        daemon_threads = True
+
+        def get_request(self):
+            request = super().get_request()
+            accepted.append(request[1])
+            return request
+
+        def handle_error(self, request, client_address):
+            return  # Undrained pages reset their connections
+
+    server = CountingServer(("127.0.0.1", 0), Page)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/" % server.server_address[1]
+    pool = SessionPool(2)
+
+    try:
+        # Streamed like the link checker's leaf GETs, closed with the body unread unless drained first
+        for drain in (True, False):
+            for _ in range(10):
+                with pool.get(url, stream=True, timeout=5) as page:
+                    if drain:
+                        pool.drain(page)
+        assert pool.stats.requests == 20
+        assert pool.stats.new_connections == len(accepted)
+        assert len(accepted) == 10  # One kept open for the drained pages, each undrained page closes the one it used
+        logging.info("unit_session_pool passed - %s, %d accepted by the server." % (pool.stats, len(accepted)))
+    except AssertionError as ex:
+        logging.error("unit_session_pool failed - %s, %d accepted by the server." % (pool.stats, len(accepted)))
+        logging.debug(ex)
+    finally:
+        pool.close()
+        server.shutdown()
+
+    logging.info("***** unit_session_pool complete *****")
+
+def unit_sitemap():
+    logging.info("***** unit_sitemap starting *****")
+    index = b'''<?xml version="1.0" encoding="UTF-8"?>
+        <sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+        <sitemap><loc>https://www.sos.wa.gov/library/sitemap1.xml</loc></sitemap>
+        </sitemapindex>'''
+    urlset = b'''<?xml version="1.0" encoding="UTF-8"?>
+        <urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+        <url><loc>https://www.sos.wa.gov/library/</loc><lastmod>2019-10-01</lastmod></url>
+        <url><loc> https://www.sos.wa.gov/library/about.aspx </loc><lastmod>2019-10-01T12:00:00-07:00</lastmod></url>
+        <url><loc>https://www.sos.wa.gov/library/hours.aspx</loc></url>
+        </urlset>'''
+    sitemap = Sitemap()
+
+    try:
+        assert sitemap.parse(index) == ["https://www.sos.wa.gov/library/sitemap1.xml"]
+        assert sitemap.parse(urlset) == []
+        assert len(sitemap) == 3 and "https://www.sos.wa.gov/library/hours.aspx" in sitemap
+        assert sitemap.get(test_url) == 1569888000
+        assert sitemap.get("https://www.sos.wa.gov/library/about.aspx") == 1569956400
+        assert sitemap.get("https://www.sos.wa.gov/library/hours.aspx") is None
+        logging.info("unit_sitemap passed - %d URLs read." % len(sitemap))
+    except AssertionError as ex:
+        logging.error("unit_sitemap failed - %s" % sitemap.lastmod)
+        logging.debug(ex)
+
+    logging.info("***** unit_sitemap complete *****")
+
+def unit_status_cache():
+    logging.info("***** unit_status_cache starting *****")
+    cache = StatusCache("tests_cache.db", ttl=3600)
+    cache.put(test_url, 200, '"abc"', None)
+
+    try:
+        assert cache.lookup(test_url) == (200, {})
+        cache.ttl = 0  # Expired entries are revalidated with their ETag
+        assert cache.lookup(test_url) == (None, {"If-None-Match": '"abc"'})
+        assert cache.lookup(test_url + "missing") == (None, {})
+        logging.info("unit_status_cache passed - %s" % cache)
+    except AssertionError as ex:
+        logging.error("unit_status_cache failed - %s" % cache)
+        logging.debug(ex)
+    finally:
+        cache.close()
+
+    logging.info("***** unit_status_cache complete *****")
+
+def unit_update_links():
+    logging.info("***** unit_update_links starting *****")
+    lc.initialize_db(True)
+    lc.args = argparse.Namespace(incremental=False, depth=2)
+    parent = lc.add_url_to_db(test_url, 0)
+    links = [test_url + "nav", test_url + "a", test_url + "nav", test_url + "nav"]
+
+    try:
+        children = lc.update_links(parent, links, 0)
+        assert sorted(children) == [(test_url + "a", 1), (test_url + "nav", 1)]
+        with closing(lc.get_connection()) as conn:
+            counts = dict(conn.execute(
+                'SELECT url, url_count FROM links INNER JOIN url ON child_id = url_id WHERE parent_id=?;', [parent]))
+        assert counts == {test_url + "nav": 3, test_url + "a": 1}
+
+        # Parsed again, the page's links replace the old ones and known URLs are not scheduled twice
+        assert lc.update_links(parent, links[:2], 0) == []
+        with closing(lc.get_connection()) as conn:
+            assert conn.execute('SELECT SUM(url_count) FROM links WHERE parent_id=?;', [parent]).fetchone()[0] == 2
+        logging.info("unit_update_links passed - repeated links counted once per page.")
+    except AssertionError as ex:
+        logging.error("unit_update_links failed - unexpected links.")
+        logging.debug(ex)
+
+    lc.args = None
+    logging.info("***** unit_update_links complete *****")
+
 def unit_update_url_status():
     logging.info("***** unit_update_url_status starting *****")
     #TODO
     assert True
     logging.info("***** unit_update_url_status complete *****")
 
+def unit_url_cache():
+    logging.info("***** unit_url_cache starting *****")
+    cache = UrlCache(2)
+    cache.put(test_url + "1", 1)
+    cache.put(test_url + "2", 2)
+    cache.get(test_url + "1")  # 1 is now most recently used
+    cache.put(test_url + "3", 3)
+
+    try:
+        assert cache.get(test_url + "1") == 1
+        assert cache.get(test_url + "2") is None
+        assert cache.get(test_url + "3") == 3
+        assert cache.hits == 3 and cache.misses == 1
+        logging.info("unit_url_cache passed - %s" % cache)
+    except AssertionError as ex:
+        logging.error("unit_url_cache failed - %s" % cache)
+        logging.debug(ex)
+
+    logging.info("***** unit_url_cache complete *****")
+
 def unit_validate_url():
     logging.info("***** unit_validate_url starting *****")
     valid_urls = (
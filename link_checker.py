@@ -1,52 +1,174 @@
+import aiohttp
 import argparse
-from bs4 import BeautifulSoup
+import asyncio
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import closing
+import email.utils
+from functools import lru_cache
 import logging
+import multiprocessing
+from multiprocessing.managers import BaseManager
 import os
 import random
 import requests
 import sqlite3
+from queue import Empty
+import socket
+import ssl
+import sys
+from threading import Thread
 import time
 from urllib import parse
 import validators
 import webbrowser
-
+import zlib
+
+from Include.ConcurrencyController import ConcurrencyController
+from Include.DbWriter import DbWriter
+from Include.DnsCache import DnsCache
+from Include.Frontier import Frontier
+from Include.HostBreaker import HostBreaker
+from Include.HostLimiter import HostLimiter
+from Include.LeaseQueue import LeaseQueue
+from Include.LinkExtractor import EXTRACTORS, PageReader, extract_hrefs
+from Include.Metrics import Metrics, Reporter
+from Include.ReportWriter import REPORTS
+from Include.SeenFilter import SeenFilter
+from Include.SessionPool import ConnectionStats, SessionPool
+from Include.Sitemap import Sitemap
+from Include.StatusCache import StatusCache
 from Include.ThreadPool import ThreadPool
+from Include.UrlCache import UrlCache
 
 # Ignores SSL warnings, just need to know if page returns result
 requests.urllib3.disable_warnings(
     requests.urllib3.exceptions.InsecureRequestWarning)
 
 args = None
+compact_db = False  # Set by initialize_db from the schema of the database
+concurrency = None
+connection_stats = None
+session_pool = None
+db_writer = None
+dns_cache = None
+host_breaker = None
+host_limiter = None
+metrics = Metrics(label_names={"dead_host_skips": "host", "fetch_seconds": "host", "host_wait_seconds": "host", "retries": "class", "urls_checked": "status"})
+parse_executor = None
+seen_filter = None
+status_cache = None
+url_cache = None
+cache_file = "link_cache.db"
 db_name = "links.db"
 info_log = "link_checker.log"
+default_ports = {"http": 80, "https": 443}
+head_retry_status = 400  # HEAD responses at or above this status are confirmed with a GET
+max_retry_after = 600  # Longest Retry-After in seconds a host is paused for
+max_retry_delay = 60  # Longest backoff in seconds before a failed URL is retried
+skipped_status = -1  # Status of URLs not fetched as their host was given up on, requests that failed have status 0
+read_chunk_size = 65536  # Bytes read from a parsed page at a time
 report_log = "report.html"
+report_fetch_size = 1000  # Report rows read from the database at a time
+run_started = None  # Unix time the crawl started, URLs checked since then are not rechecked
+# url.state values, a URL is in flight from being handed to a worker until its status is saved
+state_pending = 0
+state_in_flight = 1
+state_done = 2
+max_sql_params = 999  # Host parameters per statement, the limit of SQLite builds before 3.32
+max_sitemaps = 1000  # Sitemap files read per incremental crawl, counting those listed in sitemap indexes
+worker_poll_interval = 0.5  # Seconds a worker waits when every pending URL is leased to someone else
+# Failed requests are noted as "<class>: <reason>", classes are checked in order against every exception a failure wraps
+# urllib3's NewConnectionError subclasses its ConnectTimeoutError, so only read timeouts are taken from urllib3
+error_classes = (
+    ("dns", (socket.gaierror, socket.herror)),
+    ("tls", (ssl.SSLError, ssl.CertificateError, requests.exceptions.SSLError, requests.urllib3.exceptions.SSLError, aiohttp.ClientSSLError)),
+    ("timeout", (TimeoutError, asyncio.TimeoutError, requests.exceptions.Timeout, requests.urllib3.exceptions.ReadTimeoutError, aiohttp.ServerTimeoutError)),
+    ("connect", (ConnectionRefusedError, requests.urllib3.exceptions.NewConnectionError, aiohttp.ClientConnectorError)),
+    ("reset", (ConnectionError, requests.urllib3.exceptions.ProtocolError, requests.exceptions.ChunkedEncodingError,
+               aiohttp.ServerDisconnectedError, aiohttp.ClientPayloadError)),
+)
+transient_errors = ("timeout", "connect", "reset")  # Failure classes worth retrying, the others won't go away by themselves
+transient_status = (429, 500, 502, 503, 504)
 
 
 def main():
-    global args, info_log, report_log
+    global args, cache_file, connection_stats, db_writer, dns_cache, info_log, parse_executor, report_log, run_started, seen_filter, status_cache, url_cache
 
     argParser = argparse.ArgumentParser(description="%(prog)s is a general broken link checker. Returns a list of broken URLs, their parent URL, and number of instances on the parent page.")
-    argParser.add_argument("url", nargs="+", help="The URL(s) which will be the starting point for crawling to DEPTH levels deep.")
+    argParser.add_argument("url", nargs="*", help="The URL(s) which will be the starting point for crawling to DEPTH levels deep. Not needed with --worker.")
     argParser.add_argument("-d", "--depth", type=int, default=1, help="Maximum degrees of separation of pages to crawl. 0 for unlimited depth, defaults to 1 level.")
     argParser.add_argument("-u", "--user-agent", default="Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36 link_checker/0.9", help="Alternative User-Agent to use with requests.get() headers")
     argParser.add_argument("-b", "--base", help="Alternative hostnames for crawling. By default, only URLs matching the full hostname provided by URL is checked for additional links to crawl. By setting Base, you can add additional hostnames that will be considered for link checking.")
     argParser.add_argument("-nq", "--no-query", action="store_true", help="Ignore the query portion of the url.")
     argParser.add_argument("-ak", "--acceptable-keys", nargs="+", help="Acceptable query Keys for comparing URLs, any unspeccified keys will be ignored.")
+    argParser.add_argument("-e", "--engine", default="threads", choices=["threads", "async"], help="Crawl engine. 'threads' checks URLs with a pool of worker threads, 'async' keeps many requests in flight on a single asyncio event loop. Defaults to threads.")
+    argParser.add_argument("-c", "--connections", type=int, default=100, help="Maximum number of requests in flight at one time when using the async engine. Defaults to 100.")
+    argParser.add_argument("--adaptive", action="store_true", help="Adapt the number of requests in flight, starting from --threads or --connections, to response latency, throughput and the rate of errors and 429 or 503 responses.")
+    argParser.add_argument("--min-concurrency", type=int, default=2, help="Fewest requests in flight with --adaptive. Defaults to 2.")
+    argParser.add_argument("--max-concurrency", type=int, default=64, help="Most requests in flight with --adaptive. Defaults to 64.")
+    argParser.add_argument("-p", "--pool-size", type=int, default=10, help="Maximum number of keep-alive connections held open per host. Defaults to 10.")
+    argParser.add_argument("--host-rate", type=float, default=2.0, help="Maximum requests per second sent to any one host. Use 0 for no limit. Defaults to 2.")
+    argParser.add_argument("--host-connections", type=int, default=4, help="Maximum concurrent requests to any one host. Use 0 for no limit. Defaults to 4.")
+    argParser.add_argument("--connect-timeout", type=float, default=10, help="Seconds to wait for a connection to a host. Use 0 for no limit. Defaults to 10.")
+    argParser.add_argument("--read-timeout", type=float, default=30, help="Seconds to wait for a host to send data once connected. Use 0 for no limit. Defaults to 30.")
+    argParser.add_argument("--dns-ttl", type=float, default=300, help="Seconds a host name lookup, failed or not, is reused for. Use 0 to look up every connection. Defaults to 300.")
+    argParser.add_argument("--host-failures", type=int, default=3, help="Connection failures in a row after which a host's remaining URLs are not fetched but recorded with status -1 and a note. Use 0 to always try. Defaults to 3.")
+    argParser.add_argument("--retries", type=int, default=2, help="Times a URL is retried after a timeout, a refused or reset connection or a 429, 500, 502, 503 or 504 response, waiting --retry-delay seconds before the first retry and twice as long before each next one. Other URLs are checked on meanwhile. Defaults to 2.")
+    argParser.add_argument("--retry-delay", type=float, default=1.0, help="Seconds before the first retry of a URL, randomized by up to half to spread retries out. Defaults to 1.")
+    argParser.add_argument("--head-first", action="store_true", help="Check URLs that will not be parsed with a HEAD request, falling back to a GET whose body is never downloaded when the server rejects HEAD or returns an error.")
+    argParser.add_argument("--parser", default="stream", choices=sorted(EXTRACTORS), help="Link extractor used on parsed pages. 'stream' reads tags without building a document tree, 'bs4' builds a full BeautifulSoup tree and is also the fallback if 'stream' fails. Defaults to stream.")
+    argParser.add_argument("--max-bytes", type=int, default=10 * 2 ** 20, help="Maximum bytes read from a page being parsed, larger pages are partially parsed and noted in the database. Use 0 for no limit. Defaults to 10485760 (10 MB).")
+    argParser.add_argument("--parse-processes", type=int, default=0, help="Number of processes that parse fetched pages, so parsing is not limited to one core by the GIL. Use 0 to parse in the fetching threads. Defaults to 0.")
+    argParser.add_argument("--frontier-size", type=int, default=100000, help="Maximum number of pending URLs held in memory, the rest wait in the database until workers catch up. Use 0 for no limit. Defaults to 100000.")
+    argParser.add_argument("--serve", metavar="HOST:PORT", help="Coordinate a distributed crawl, leasing URLs to --worker processes connecting on HOST:PORT and saving what they report. The coordinator keeps the database and writes the report. Requests to the port are unpickled, so anyone holding --auth-key can run code on the coordinator: only serve on a trusted network, never on a port exposed to the internet.")
+    argParser.add_argument("--worker", metavar="HOST:PORT", help="Check URLs leased from the --serve coordinator at HOST:PORT with --threads threads, until the crawl is finished. Workers keep no database. Answers from the coordinator are unpickled, only connect to one on a trusted network.")
+    argParser.add_argument("--auth-key", default=os.environ.get("LINK_CHECKER_AUTH_KEY"), help="Shared secret of the coordinator and its workers, required by --serve and --worker. Use a long random value, it is all that stops others from running code on them. Defaults to the LINK_CHECKER_AUTH_KEY environment variable, which keeps it out of process listings.")
+    argParser.add_argument("--lease-seconds", type=float, default=300, help="Seconds a worker has to report a leased URL before it is handed to another worker. Defaults to 300.")
     argParser.add_argument("-t", "--threads", type=int, default=2, help="Sets the number of concurrent threads that can be processed at one time. Be aware that increasing thread count will increase the frequency of requests to the server. Use 0 to disable multi-threading.")
     argParser.add_argument("-r", "--reset", action="store_true", help="Resets logs and local links database, restarting crawl. Default (no flag) continues where previous crawl completed.")
+    argParser.add_argument("-i", "--incremental", action="store_true", help="Recrawl a completed crawl keeping its links. Only pages changed since they were checked are parsed again, going by sitemap lastmod dates or conditional requests, and only links new to those pages are rechecked.")
+    argParser.add_argument("--sitemap", nargs="+", help="Sitemap or sitemap index URL(s) read by --incremental. Defaults to the sitemaps listed in robots.txt of each URL's host, or its /sitemap.xml.")
+    argParser.add_argument("--checkpoint-interval", type=float, default=60, help="Seconds between checkpoints, which commit queued database writes and fold the write-ahead log into the database, so a crash loses at most that much work. Use 0 to disable. Defaults to 60.")
+    argParser.add_argument("--compact-db", action="store_true", help="Create the database with the compact schema for very large crawls. URLs are stored once and found by a hash, links are stored once with an index covering the report. Takes effect on a new database or with --reset, an existing database keeps its schema.")
+    argParser.add_argument("--db-batch-size", type=int, default=500, help="Number of database writes committed together in one transaction. Defaults to 500.")
+    argParser.add_argument("--db-flush-interval", type=float, default=1.0, help="Maximum seconds a database write waits before its batch is committed. Defaults to 1.0.")
+    argParser.add_argument("--url-cache-size", type=int, default=100000, help="Number of URL ids kept in memory to skip database lookups for repeated links. Use 0 to disable. Defaults to 100000.")
+    argParser.add_argument("--seen-memory", type=float, default=16, help="Megabytes for the in-memory filter of URLs already seen, which lets new links skip database lookups. Use 0 to disable. Defaults to 16.")
+    argParser.add_argument("--seen-error-rate", type=float, default=0.01, help="Target false-positive rate of the seen-URL filter, false positives fall back to a database lookup. Defaults to 0.01.")
+    argParser.add_argument("--cache-file", default=cache_file, help="Filename of the link status cache kept between runs, it is not cleared by --reset. Defaults to %s." % cache_file)
+    argParser.add_argument("--cache-ttl", type=float, default=24, help="Hours a cached link status is trusted before the link is revalidated with a conditional request. Defaults to 24.")
+    argParser.add_argument("--no-cache", action="store_true", help="Check every link without consulting or updating the link status cache.")
+    argParser.add_argument("--progress-interval", type=float, default=10, help="Seconds between progress lines on stderr and in the log. Use 0 to disable. Defaults to 10.")
+    argParser.add_argument("--metrics-file", help="Filename to write crawl metrics to at the end of the run: fetch latency per host, parse and database times, bytes downloaded and URL counts.")
+    argParser.add_argument("--metrics-format", default="json", choices=["json", "prometheus"], help="Format of --metrics-file, JSON or Prometheus text. Defaults to json.")
     argParser.add_argument("--report-file", default=report_log, help="Filename of final report. Defaults to %s" % report_log)
+    argParser.add_argument("--report-format", choices=sorted(REPORTS), help="Format of the report: html, csv or jsonl (JSON Lines). Defaults to the extension of --report-file, or html.")
+    argParser.add_argument("--ignore-status", type=int, nargs="*", default=[401, 405, 500, 503], help="Status codes left out of the report. Requests that failed without an answer have status 0, and URLs not fetched because their host was given up on have -1. Defaults to 401 405 500 503.")
+    argParser.add_argument("--no-browser", action="store_true", help="Don't open the report in a web browser when it is written.")
+    argParser.add_argument("--report-only", action="store_true", help="Write the report from the database of an earlier crawl without crawling.")
     argParser.add_argument("-l", "--log-level", default="INFO", choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"], help="Log level to report in %s." % info_log)
     argParser.add_argument("--log-file", default=info_log,help="Filename of informational log. Defaults to %s." % info_log)
     args = argParser.parse_args()
+    if args.reset and args.incremental:
+        argParser.error("--reset and --incremental can't be combined, an incremental crawl needs the links of the last one.")
+    if not args.url and not args.worker and not args.report_only:
+        argParser.error("the following arguments are required: url")
+    if args.serve and args.worker:
+        argParser.error("--serve and --worker can't be combined.")
+    if (args.serve or args.worker) and not args.auth_key:
+        argParser.error("--serve and --worker need --auth-key or LINK_CHECKER_AUTH_KEY, a secret shared by the coordinator and its workers.")
 
     info_log = args.log_file
     report_log = args.report_file
 
+    # The log is always appended to, as parser processes share the file, so a reset truncates it up front
+    if args.reset:
+        open(info_log, "w").close()
     logging.basicConfig(
         level=args.log_level,
         filename=info_log,
-        filemode="w+" if args.reset else "a",
+        filemode="a",
         format="%(asctime)s\t%(levelname)s\t%(message)s")
     logging.info("***** link_checker started *****")
     logging.debug(args)
@@ -55,120 +177,636 @@ def main():
         logging.error("Invalid URL paremeter provded.")
         exit("Please enter valid URL(s)")
 
-    # Initialize threadpool
-    pool = ThreadPool(args.threads if args.threads > 0 else 1)
-    
+    if args.report_only:
+        if not os.path.exists(db_name):
+            exit("No database %s to report on." % db_name)
+        write_report()
+        return
+
     # Initialize database and variable
     args.base = set() if args.base is None else {args.base}
-    initialize_db(args.reset)
-
-    # Process initial URLs
     for url in args.url:
         args.base.add(parse.urlsplit(url).hostname)
-        if args.threads == 0:
-            process_url(url, True)
-        else:
-            pool.add_task(process_url, url, True)
+    run_started = time.time()
+    cache_file = args.cache_file
+    if args.dns_ttl > 0:
+        dns_cache = DnsCache(args.dns_ttl)
+        dns_cache.install()
+    if not args.no_cache:
+        status_cache = StatusCache(cache_file, args.cache_ttl * 3600)
+
+    # Workers leave the database to the coordinator
+    if not args.worker:
+        initialize_db(args.reset, args.compact_db)
+        url_cache = UrlCache(args.url_cache_size)
+        if args.seen_memory > 0:
+            seen_filter = SeenFilter(args.seen_memory * 2 ** 20, args.seen_error_rate)
+        if args.incremental:
+            if status_cache is None:
+                logging.warning("Incremental crawl without the link status cache, pages missing from sitemaps are parsed again.")
+            mark_changed_pages(load_sitemap())
+        if not args.reset:
+            load_url_cache()
+            load_seen_filter()
+
+    # Parser processes are spawned rather than forked as the crawl starts several threads
+    if args.parse_processes > 0:
+        parse_executor = ProcessPoolExecutor(
+            args.parse_processes, multiprocessing.get_context("spawn"),
+            init_parse_process, (args.log_level, info_log))
+
+    # Workers hand all database writes to a single batched writer for the duration of the crawl
+    if connection_stats is None:
+        connection_stats = ConnectionStats()  # Sitemap requests of an incremental crawl may have created it
+    metrics.reset()
+    if not args.worker:
+        db_writer = DbWriter(db_name, args.db_batch_size, args.db_flush_interval, metrics)
+    reporter = Reporter(args.progress_interval, log_progress) if args.progress_interval > 0 else None
+    checkpointer = Reporter(args.checkpoint_interval, checkpoint) if args.checkpoint_interval > 0 and db_writer is not None else None
+    if args.worker:
+        crawl_worker()
+    elif args.serve:
+        crawl_coordinator()
+    elif args.engine == "async":
+        asyncio.run(crawl_async())
+    else:
+        crawl_threaded()
+    if reporter is not None:
+        reporter.stop()
+        log_progress()
+    if checkpointer is not None:
+        checkpointer.stop()
+    if db_writer is not None:
+        db_writer.close()
+        db_writer = None
+    if parse_executor is not None:
+        parse_executor.shutdown()
+        parse_executor = None
+    logging.info("Connection reuse: %s" % connection_stats)
+    if concurrency is not None and concurrency.adaptive:
+        logging.info("Concurrency: %s" % concurrency)
+    if dns_cache is not None:
+        logging.info("DNS cache: %s" % dns_cache)
+        dns_cache.uninstall()
+        dns_cache = None
+    logging.info("Dead hosts: %s" % get_breaker())
+    if url_cache is not None:
+        logging.info("URL cache: %s" % url_cache)
+    if seen_filter is not None:
+        logging.info("Seen filter: %s" % seen_filter)
+    if status_cache is not None:
+        logging.info("Link status cache: %s" % status_cache)
+        status_cache.close()
+        status_cache = None
+    log_time_spent()
+    if args.metrics_file:
+        with open(args.metrics_file, "w") as f:
+            f.write(metrics.to_json() if args.metrics_format == "json" else metrics.to_prometheus())
+        logging.info("Metrics written to %s." % args.metrics_file)
+    if args.worker:
+        logging.info("***** link_checker worker finished *****")
+        return  # The coordinator writes the report
+
+    write_report()
+
+
+def abandon_url(url, depth):
+    # URLs no worker reported back on are saved with status 0, so they show up in the report
+    get_content = args.depth == 0 or depth < args.depth
+    save_result((parse_url(url, not args.no_query, args.acceptable_keys), 0, None, None, "No worker reported back"), get_content, depth)
 
-    pool.wait_completion()
 
-    currentDepth = 1
-    while args.depth == 0 or currentDepth < args.depth:
-        logging.info("Current page depth: %d" % currentDepth)
-        # get unprocessed URLs
-        urls = get_urls()
+def add_link(parent, child):
+    return add_links(parent, [(child, 1)])
 
-        if len(urls) == 0:
-            logging.info("No URLs to check, exiting main loop.")
-            break
 
-        for url in urls:
-            pool.add_task(process_url, url, True)
-        pool.wait_completion()
-        currentDepth += 1
-    else:
-        urls = get_urls()
-        for url in urls:
-            pool.add_task(process_url, url, False)
-        pool.wait_completion()
+def add_links(parent, children):
+    # Adds (child_id, count) links from parent in one statement, adding to the count of links already there
+    def write(conn):
+        try:
+            logging.info(
+                "Updating links table - parent_id: %d | children: %d" % (parent, len(children)))
+            conn.executemany('''
+                INSERT INTO links (parent_id, child_id, url_count) VALUES (?, ?, ?)
+                ON CONFLICT (parent_id, child_id) DO UPDATE SET url_count=url_count+excluded.url_count;
+                ''', [(parent, child, count) for child, count in children])
+        except sqlite3.Error as e:
+            logging.debug("Database error: %s" % e)
+            logging.critical("Database error - ensure database is writable.")
+            return False
+        return True
 
-    # Export report
-    logging.info("Creating link report.")
-    results = get_error_urls()
-    with open(report_log, "w") as f:
-        print("<html>", file=f)
-        print("<head>", file=f)
-        print("<style>", file=f)
-        print("    h1 { font-size: 1.2em; }", file=f)
-        print("    li { vertical-align: top; max-width: 80vw; white-space: nowrap; overflow: hidden; text-overflow: ellipsis; }", file=f)
-        print(
-            "    .status { display: inline-block; width: 30px; color: red; margin-right: 1em; text-align: right; }", file=f)
-        print("</style>", file=f)
-        print("</head>", file=f)
-        print("<body>", file=f)
-        print("<h1>Link_Checker Results</h1>", file=f)
-        heading = ""
-        ignore_status = [401, 405, 500, 503]
-        if not results:
-            print("<p>No bad links found</p>", file=f)
-        for result in results:
-            if result['status'] in ignore_status:
-                # Access forbidden, ignore
-                continue
+    return write_db(write, wait=False)
 
-            if heading != result['parent']:
-                if heading != "":
-                    print("</ul>", file=f)
-                print(
-                    "<h2><a href='{url}' target='_blank'>{url}</a></h2>".format(url=result['parent']), file=f)
-                print("<ul>", file=f)
-                heading = result['parent']
 
-            print("<li><span class='status'>{status}</span><a href='{url}' target='_blank'>{url}</a></li>".format(
-                url=result['child'], status=result['status']), file=f)
+def add_url_to_db(url, depth=None):
+    return insert_url(url, depth)[0]  # Inserts URL if necessary, returns Id
 
-        print("</ul>", file=f)  # Close final list
-        print("</body>", file=f)
-        print("</html>", file=f)
-    webbrowser.open('file://' + os.path.realpath(report_log), new=2)
 
+async def async_get_page(session, url, get_body=True, retry=False):
+    # The status cache is a blocking sqlite database, it is read and written off the event loop
+    cached_status, headers = None, {}
+    if status_cache is not None:
+        cached_status, headers = await asyncio.to_thread(check_cache, url, get_body, retry)
+    if cached_status is not None:
+        return CachedResponse(url, cached_status)
 
-def add_link(parent, child):
-    with closing(get_connection()) as conn:
+    host = parse.urlsplit(url).hostname
+    if get_breaker().dead(parse.urlsplit(url).netloc) is not None:
+        return skipped_response(url)
+    waited = time.perf_counter()
+    async with get_limiter().async_limit(host):
+        metrics.observe("host_wait_seconds", time.perf_counter() - waited, host)
+        started = time.perf_counter()
         try:
-            logging.info(
-                "Updating links table - parent_id: %d | child_id: %d" % (parent, child))
-            conn.execute('INSERT INTO links (parent_id, child_id, url_count) VALUES (?, ?, ?);', [
-                         parent, child, 1])
-        except sqlite3.IntegrityError:
-            logging.info("Item already exists, updating record.")
-            conn.execute(
-                'UPDATE links SET url_count=url_count+1 WHERE parent_id=? AND child_id=?', [parent, child])
+            with metrics.timer("fetch_seconds", host):
+                page = None
+                if args.head_first and not get_body:
+                    page = await session.head(url, headers=headers, allow_redirects=True)
+                    if page.status >= head_retry_status:
+                        logging.info("HEAD returned %d for %s, retrying with GET." % (page.status, url))
+                        page.release()
+                        page = None
+                if page is None:
+                    page = await session.get(url, headers=headers, allow_redirects=True)
+        except Exception as e:
+            observe_response(host, started, 0, {})
+            return failed_response(url, e)
+    get_breaker().success(parse.urlsplit(url).netloc)
+    observe_response(host, started, page.status, page.headers)
+
+    status = page.status
+    if status_cache is not None:
+        status = await asyncio.to_thread(update_cache, url, page.status, page.headers)
+    if status != page.status:
+        page.release()
+        return CachedResponse(url, status)
+    return page
+
+
+async def async_check_url(session, url, get_content=True, retry=False):
+    # Asyncio counterpart of check_url
+    url = parse_url(url, not args.no_query, args.acceptable_keys)
+    redirect = links = notes = None
+
+    parse_page = get_content and parse.urlsplit(url).hostname in args.base
+    async with await async_get_page(session, url, parse_page, retry) as page:
+        status = page.status
+        metrics.count("urls_checked", label=status)
+        if isinstance(page, FailedResponse):
+            notes = page.notes
+
+        if len(page.history) > 0:
+            redirect = str(page.url)
+
+        if (parse_page
+            and status == 200
+            and "text/html" in page.headers.get('content-type', '')):
+            reader = get_reader(page.charset)
+            try:
+                async for chunk in page.content.iter_chunked(read_chunk_size):
+                    if not reader.feed(chunk):
+                        break
+            except Exception as e:
+                return url, 0, redirect, None, failed_response(url, e).notes
+            if parse_executor is not None:
+                reader.close()
+                start = time.perf_counter()
+                links = await asyncio.get_running_loop().run_in_executor(
+                    parse_executor, extract_links, url, reader.text, not args.no_query, args.acceptable_keys, args.parser)
+                metrics.observe("parse_seconds", reader.seconds + time.perf_counter() - start)
+            else:
+                # Building the soup and canonicalizing every link would hold up every other request on the loop
+                links = await asyncio.to_thread(parse_content, url, reader)
+            metrics.count("bytes_downloaded", reader.size)
+            metrics.count("links_found", len(links))
+            notes = truncation_note(url, reader)
+
+    return url, status, redirect, links, notes
+
+
+async def async_process_url(session, url, get_content=True, depth=None, frontier=None):
+    # Asyncio counterpart of process_url
+    logging.info("Processing Url: %s. get_content is %s" %
+                 (url, str(get_content)))
+
+    result = await async_check_url(session, url, get_content, frontier is not None and frontier.attempts(url) > 0)
+    if frontier is not None:
+        result = retry_or_keep(frontier, result, depth)
+        if result is None:
+            return []
+    # Saving waits on the database writer, which may be committing, so it runs in a thread as it does for crawl_threaded
+    return await asyncio.to_thread(save_result, result, get_content, depth)
+
+
+def build_url(split, use_queries=True, keys=None):
+    # Rebuilds a urlsplit() result with lowercase scheme and host, no default port or fragment, and the query filtered by keys
+    scheme = split.scheme.lower()
+    netloc = split.hostname or ""
+    if ":" in netloc:
+        netloc = "[" + netloc + "]"  # IPv6 literal
+    if "@" in split.netloc:
+        netloc = split.netloc.rpartition("@")[0] + "@" + netloc
+    port = split.port
+    if port is not None and port != default_ports.get(scheme):
+        netloc += ":%d" % port
+
+    query = ""
+    if keys and split.query:
+        # rebuild query with acceptable key/value pairs only
+        query_args = {x.partition("=")[0]: x for x in split.query.split("&")}
+        query = "&".join(query_args[ak] for ak in keys if ak in query_args)
+    elif use_queries and not keys:
+        query = split.query
+
+    return scheme + "://" + netloc + (split.path or "/") + ("?" + query if query else "")
+
+
+def canonicalize_links(base, hrefs, use_queries=True, keys=None):
+    # Returns the valid, normalized links among hrefs found on base
+    links = []
+    keys = tuple(keys) if keys else None
+    for href in hrefs:
+        link = canonicalize_url(base, href, use_queries, keys)
+        if link is not None:
+            logging.debug("Found: " + link)
+            links.append(link)
+
+    return links
+
+
+@lru_cache(maxsize=65536)
+def canonicalize_url(base, href, use_queries=True, keys=None):
+    # Joins, normalizes and validates href found on base in one pass, returns None if it can't be checked
+    # Memoized because pages repeat the same hrefs, so keys must be hashable (a tuple)
+    try:
+        split = parse.urlsplit(parse.urljoin(base, href.strip(), False))
+        if split.scheme.lower() not in default_ports or not split.hostname:
+            return None
+        url = build_url(split, use_queries, keys)
+    except ValueError:
+        return None
+
+    return url if validators.url(url) else None
+
+
+def checkpoint():
+    # Commits the writes queued so far and folds the write-ahead log into the database, a restart resumes from here
+    def write(conn):
+        try:
+            conn.commit()
+            return conn.execute('PRAGMA wal_checkpoint(PASSIVE);').fetchone()[2]
         except sqlite3.Error as e:
-            logging.debug("Database error: %s" % e)
-            logging.critical("Database error - ensure database is writable.")
-            return False
-        conn.commit()
+            logging.error("Database error: %s" % e)
+            return 0
+
+    with metrics.timer("checkpoint_seconds"):
+        pages = write_db(write)
+    logging.info("Checkpoint: %d URLs checked so far, %d write-ahead log pages copied to the database." % (
+        metrics.total("urls_checked"), max(pages, 0)))
+
+
+def check_cache(url, get_body=True, retry=False):
+    # Returns (status, None) when url has a fresh cached result, otherwise (None, conditional request headers)
+    # Pages that will be parsed need their body, so they are fetched in full unless an incremental crawl kept their links
+    # A retry always goes to the network, it follows a failure the cache can't answer for
+    if status_cache is None or retry or get_body and not args.incremental:
+        return None, {}
+    if get_body:
+        return None, status_cache.validators(url)
+    return status_cache.lookup(url)
+
+
+def check_url(url, get_content=True, retry=False):
+    # Fetch head or head + contents of a URL and extract its links, without touching the database so workers can run it
+    # Returns (url, status, redirected url or None, links or None if the page was not parsed, notes or None)
+    # retry skips the status cache, for URLs checked again after a transient failure
+    url = parse_url(url, not args.no_query, args.acceptable_keys)
+    redirect = links = notes = None
+
+    # Accept URL input and get page, pages that won't be parsed don't need their body
+    parse_page = get_content and parse.urlsplit(url).hostname in args.base
+    with get_page(url, parse_page, retry) as page:
+
+        # get status code of url
+        status = page.status_code
+        metrics.count("urls_checked", label=status)
+        if isinstance(page, FailedResponse):
+            notes = page.notes
+
+        # if page.history then the final redirected url is saved with the same status
+        if len(page.history) > 0:
+            redirect = page.url
+
+        # if current url is in args.base, and get_content, and url status code is OK, finally page is of the appropriate type, then scrape page for new links
+        # Pages answered from the status cache have no body or headers, an incremental crawl keeps their links
+        if (parse_page
+            and status == 200
+            and "text/html" in page.headers.get('content-type', '')):
+            # The body is decoded and parsed as it arrives, up to --max-bytes
+            reader = get_reader(page.encoding)
+            try:
+                for chunk in page.iter_content(read_chunk_size):
+                    if not reader.feed(chunk):
+                        break
+            except Exception as e:
+                # A body cut off part way failed like any other request
+                return url, 0, redirect, None, failed_response(url, e).notes
+            links = parse_content(url, reader)
+            metrics.count("bytes_downloaded", reader.size)
+            metrics.count("links_found", len(links))
+            notes = truncation_note(url, reader)
+
+        # Closing a response with its body unread closes the connection too, small bodies are cheaper to read
+        get_session().drain(page)
+
+    return url, status, redirect, links, notes
+
+
+def classify_error(error):
+    # Class in error_classes of a failed request, going through the exceptions it was raised from or wraps
+    # Libraries wrap the socket error that caused a failure in their own exceptions, sometimes several deep
+    found = []
+    pending = [error]
+    while pending:
+        e = pending.pop()
+        if not isinstance(e, BaseException) or any(e is seen for seen in found):
+            continue
+        found.append(e)
+        pending += [getattr(e, "reason", None), getattr(e, "os_error", None), e.__cause__, e.__context__] + list(e.args)
+    for name, types in error_classes:
+        if any(isinstance(e, types) for e in found):
+            return name
+    return "error"
+
+
+async def crawl_async():
+    # Single event loop crawl, each URL is started as soon as a connection slot frees up
+    frontier = Frontier(args.frontier_size, get_urls)
+    put_start_urls(frontier)
+
+    # Every put and task_done happens on the event loop, so an Event is enough to wait for new URLs and free slots
+    changed = asyncio.Event()
+    limit = get_concurrency(max(args.connections, 1))
+
+    async def check(session, url, depth):
+        try:
+            get_content = args.depth == 0 or depth < args.depth
+            for child, child_depth in await async_process_url(session, url, get_content, depth, frontier):
+                frontier.put(child, child_depth)
+        except Exception as e:
+            logging.error("Error processing %s: %s" % (url, e))
+        finally:
+            frontier.task_done(url)
+            update_frontier_gauges(frontier)
+            limit.release()
+            changed.set()
+
+    # Count new and reused connections the same way SessionPool does for the threaded engine
+    async def on_create(session, context, params):
+        connection_stats.connection_created()
+        connection_stats.request_sent()
+
+    async def on_reuse(session, context, params):
+        connection_stats.request_sent()
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_end.append(on_create)
+    trace_config.on_connection_reuseconn.append(on_reuse)
+
+    connector = aiohttp.TCPConnector(
+        limit=limit.maximum, limit_per_host=args.pool_size, ssl=False)
+    headers = {"User-Agent": args.user_agent}
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=args.connect_timeout or None, sock_read=args.read_timeout or None)
+    async with aiohttp.ClientSession(connector=connector, headers=headers, timeout=timeout, trace_configs=[trace_config]) as session:
+        tasks = set()
+        while True:
+            # A get that empties the frontier refills it from the database, so it runs in a thread
+            # Checks finishing meanwhile set changed, it is cleared first so their wakeup is not lost
+            changed.clear()
+            try:
+                item = await asyncio.to_thread(frontier.get, False)
+            except Empty:
+                try:
+                    await asyncio.wait_for(changed.wait(), frontier.next_due())
+                except asyncio.TimeoutError:
+                    pass  # A URL deferred for a retry is due
+                continue
+
+            if item is None:
+                logging.info("No URLs to check, exiting main loop.")
+                break
+            if defer_if_paused(frontier, *item):
+                continue
+            mark_in_flight(item[0])
+            update_frontier_gauges(frontier)
+
+            while not limit.try_acquire():
+                changed.clear()
+                await changed.wait()
+            task = asyncio.create_task(check(session, *item))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+
+
+def crawl_coordinator():
+    # Serves the frontier to --worker processes, which may be on other hosts, and saves what they report
+    frontier = Frontier(args.frontier_size, get_urls)
+    put_start_urls(frontier)
+    settings = {"base": sorted(args.base), "depth": args.depth, "no_query": args.no_query, "acceptable_keys": args.acceptable_keys}
+    queue = LeaseQueue(frontier, lambda url, depth, result: record_result(url, depth, result, frontier),
+                       abandon_url, args.lease_seconds, settings=settings, leased=mark_in_flight)
+
+    CrawlManager.register("queue", callable=lambda: queue)
+    server = CrawlManager(address=parse_address(args.serve), authkey=args.auth_key.encode()).get_server()
+    Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Coordinator listening on %s:%d." % server.address)
+
+    # Expired leases are also reclaimed here, in case every worker is gone
+    while not queue.finished.wait(1):
+        queue.expire()
+        update_frontier_gauges(frontier)
+    logging.info("No URLs to check, stopping coordinator.")
+    server.stop_event.set()
+
+
+def crawl_threaded():
+    # Initialize threadpool and the keep-alive session its workers share
+    # The pool has a thread for every request the concurrency limit may allow, the limit decides how many are busy
+    limit = get_concurrency(max(args.threads, 1))
+    pool = ThreadPool(limit.maximum if args.threads > 0 else 1)
+    session = get_session()
+
+    # Workers pull the shallowest pending URL as soon as they are free instead of waiting for a whole level
+    # URLs past --frontier-size, and those left unchecked by a previous run, are read back from the database
+    frontier = Frontier(args.frontier_size, get_urls)
+    put_start_urls(frontier)
+
+    def check(url, depth):
+        try:
+            get_content = args.depth == 0 or depth < args.depth
+            for child, child_depth in process_url(url, get_content, depth, frontier):
+                frontier.put(child, child_depth)
+        finally:
+            frontier.task_done(url)
+            update_frontier_gauges(frontier)
+            limit.release()
+
+    while True:
+        item = frontier.get()
+        if item is None:
+            logging.info("No URLs to check, exiting main loop.")
+            break
+        if defer_if_paused(frontier, *item):
+            continue
+        mark_in_flight(item[0])
+        update_frontier_gauges(frontier)
+
+        limit.acquire()
+        if args.threads == 0:
+            check(*item)
+        else:
+            pool.add_task(check, *item)
+
+    session.close()
+
+
+def crawl_worker():
+    # Checks URLs leased from the --worker coordinator in --threads threads until the crawl is finished
+    CrawlManager.register("queue")
+    manager = CrawlManager(address=parse_address(args.worker), authkey=args.auth_key.encode())
+    manager.connect()
+    queue = manager.queue()
+    settings = queue.get_settings()
+    args.base = set(settings["base"])
+    args.depth = settings["depth"]
+    args.no_query = settings["no_query"]
+    args.acceptable_keys = settings["acceptable_keys"]
+    name = "%s:%d" % (socket.gethostname(), os.getpid())
+    logging.info("Worker %s connected to %s." % (name, args.worker))
+
+    # Threads past the concurrency limit wait before claiming, so they hold no leases meanwhile
+    limit = get_concurrency(max(args.threads, 1))
+
+    def work():
+        while True:
+            limit.acquire()
+            try:
+                items = queue.claim(name)
+                for url, depth in items or []:
+                    # URLs on a host this worker was told to pause go back to the coordinator until the pause is over
+                    paused = get_limiter().paused(parse.urlsplit(url).hostname)
+                    if paused:
+                        queue.defer(name, url, paused)
+                        continue
+                    get_content = args.depth == 0 or depth < args.depth
+                    logging.info("Processing Url: %s. get_content is %s" % (url, str(get_content)))
+                    try:
+                        result = check_url(url, get_content)
+                    except Exception as e:
+                        logging.error("Error processing %s: %s" % (url, e))
+                        continue  # The lease expires and another worker retries it
+                    queue.report(name, url, result)
+            except (EOFError, OSError) as e:
+                logging.info("Coordinator closed the connection: %s" % e)
+                return
+            finally:
+                limit.release()
+
+            if items is None:
+                logging.info("No URLs to check, exiting worker.")
+                return
+            if not items:
+                time.sleep(worker_poll_interval)
+
+    threads = [Thread(target=work) for _ in range(limit.maximum)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    get_session().close()
+
+
+def defer_if_paused(frontier, url, depth):
+    # Hands a URL whose host is paused back to the frontier until the pause is over, rather than holding a slot while it waits
+    seconds = get_limiter().paused(parse.urlsplit(url).hostname)
+    if not seconds:
+        return False
+    logging.info("%s is paused, checking %s in %.0f seconds." % (parse.urlsplit(url).hostname, url, seconds))
+    frontier.defer(url, depth, seconds, attempt=False)
+    frontier.task_done(url)
     return True
 
 
-def add_url_to_db(url):
-    with closing(get_connection()) as conn:
-        link = parse.urldefrag(url).url
+def delete_links(parent):
+    def write(conn):
+        try:
+            conn.execute('DELETE FROM links WHERE parent_id=?;', [parent])
+        except sqlite3.Error as e:
+            logging.error("Database error: %s" % e)
+            return False
+        return True
+
+    return write_db(write, wait=False)
 
+
+def extract_links(base, content, use_queries=True, keys=None, extractor="stream"):
+    # Returns the valid, normalized links in content, depends only on its arguments so it can run in a parser process
+    return canonicalize_links(base, extract_hrefs(content, extractor), use_queries, keys)
+
+
+def failed_response(url, error):
+    # Response for a request that raised, noted with the class of failure, status 0 as there was no answer
+    # Hosts that can't be connected to count towards being given up on
+    # Hosts are told apart by port as well, a dead service says nothing of others on the same machine
+    reason = error.args[0].reason if error.args and hasattr(error.args[0], "reason") else error
+    if isinstance(reason, requests.urllib3.exceptions.NewConnectionError):
+        reason = str(reason).partition(": ")[2] or reason  # Drop the connection object's repr
+    notes = "%s: %s" % (classify_error(error), str(reason) or type(reason).__name__)
+    logging.info("Request for %s failed, %s" % (url, notes))
+    host = parse.urlsplit(url).netloc
+    if is_connect_error(error) and get_breaker().failure(host, reason):
+        logging.warning("%s failed to connect %d times in a row, not fetching its remaining URLs: %s" % (host, args.host_failures, reason))
+    return FailedResponse(url, 0, notes)
+
+
+def flush_db():
+    # Commits queued writes so reads on other connections see them
+    if db_writer is not None:
+        db_writer.flush()
+
+
+def get_breaker():
+    # Per-host connection failure counts, created on first use when called outside main
+    global host_breaker
+    if host_breaker is None:
+        host_breaker = HostBreaker(args.host_failures)
+    return host_breaker
+
+
+def get_children(parent):
+    # url_ids linked from parent, read through the writer so queued link changes are included
+    def read(conn):
         try:
-            logging.info("Adding URL '%s' to database." % link)
-            c = conn.execute('INSERT INTO url (url) VALUES (?);', [link])
-            conn.commit()
-            return c.lastrowid
-        except sqlite3.IntegrityError as e:
-            logging.warning("URL '%s' already found in database." % link)
-            c = conn.execute('SELECT url_id FROM url WHERE url=?', [link])
-            return c.fetchone()[0]
+            return {row[0] for row in conn.execute('SELECT child_id FROM links WHERE parent_id=?;', [parent])}
         except sqlite3.Error as e:
-            logging.debug("Database error: %s" % e)
-            logging.critical("Database error - ensure database is writable.")
-            return None
+            logging.error("Database error: %s" % e)
+            return set()
+
+    return write_db(read)
+
+
+def get_concurrency(initial):
+    # Limit on requests in flight, fixed at initial unless --adaptive, created on first use when called outside main
+    global concurrency
+    if concurrency is None:
+        if args.adaptive:
+            concurrency = ConcurrencyController(args.min_concurrency, args.max_concurrency, initial, metrics=metrics)
+            logging.info("Adaptive concurrency: %s." % concurrency)
+        else:
+            concurrency = ConcurrencyController(initial, initial)
+    return concurrency
 
 
 def get_connection():
@@ -176,47 +814,142 @@ def get_connection():
     return sqlite3.connect(db_name)
 
 
-def get_error_urls():
+def get_content_bytes(url):
+    # Body of a file such as a sitemap, or None if it can't be fetched
+    try:
+        with get_limiter().limit(parse.urlsplit(url).hostname):
+            page = get_session().get(url, allow_redirects=True, verify=False, timeout=(args.connect_timeout or None, args.read_timeout or None))
+    except Exception as e:
+        logging.warning("Could not fetch %s: %s" % (url, e))
+        return None
+    if page.status_code != 200:
+        logging.info("%s returned %d." % (url, page.status_code))
+        return None
+    return page.content
+
+
+def get_error_urls(ignore_status=()):
+    # Yields the broken links as they are read, so reports of large crawls are never held in memory
+    flush_db()
+    ignore_status = list(ignore_status)
     try:
         logging.info("Fetching URLs with error status.")
         with closing(get_connection()) as conn:
             conn.row_factory = sqlite3.Row
+            # Failed requests have status 0 and URLs skipped on dead hosts skipped_status, -1
+            # Listing them rather than using a range keeps the compact schema's errors index in use without statistics
             cursor = conn.execute(''' 
-                SELECT p.url AS 'parent', c.url AS 'child', url_count AS 'count', c.status 
+                SELECT p.url AS 'parent', c.url AS 'child', url_count AS 'count', c.status, c.notes 
                 FROM links 
                 INNER JOIN url AS p ON parent_id = p.url_id 
                 INNER JOIN url AS c ON child_id = c.url_id 
-                WHERE c.status > 403 OR c.status = 0
+                WHERE (c.status > 403 OR c.status IN (0, -1)) AND c.status NOT IN (%s)
                 ORDER BY parent, c.status, child;
-                ''')
-            return cursor.fetchall()
+                ''' % ",".join("?" * len(ignore_status)), ignore_status)
+            rows = cursor.fetchmany(report_fetch_size)
+            while rows:
+                yield from rows
+                rows = cursor.fetchmany(report_fetch_size)
     except sqlite3.Error as e:
         logging.error("Database error: %s" % e)
         exit("Database error: %s" % e)
 
 
-def get_page(url):
-    headers = {"User-Agent": args.user_agent}
-
-    try:
-        return requests.get(url, headers=headers, allow_redirects=True, verify=False, stream=True)
-    except:
-        return FailedResponse(url)
-
-
-def get_urls():
+def get_limiter():
+    # Per-host politeness limits, created on first use when called outside main
+    global host_limiter
+    if host_limiter is None:
+        host_limiter = HostLimiter(args.host_rate, args.host_connections)
+    return host_limiter
+
+
+def get_page(url, get_body=True, retry=False):
+    # Bodies are streamed, so only pages that get parsed are ever downloaded
+    cached_status, headers = check_cache(url, get_body, retry)
+    if cached_status is not None:
+        return CachedResponse(url, cached_status)
+
+    host = parse.urlsplit(url).hostname
+    if get_breaker().dead(parse.urlsplit(url).netloc) is not None:
+        return skipped_response(url)
+    timeout = (args.connect_timeout or None, args.read_timeout or None)
+    waited = time.perf_counter()
+    with get_limiter().limit(host):
+        metrics.observe("host_wait_seconds", time.perf_counter() - waited, host)
+        started = time.perf_counter()
+        try:
+            with metrics.timer("fetch_seconds", host):
+                page = None
+                if args.head_first and not get_body:
+                    page = get_session().head(url, headers=headers, allow_redirects=True, verify=False, timeout=timeout)
+                    if page.status_code >= head_retry_status:
+                        logging.info("HEAD returned %d for %s, retrying with GET." % (page.status_code, url))
+                        page.close()
+                        page = None
+                if page is None:
+                    page = get_session().get(url, headers=headers, allow_redirects=True, verify=False, stream=True, timeout=timeout)
+        except Exception as e:
+            observe_response(host, started, 0, {})
+            return failed_response(url, e)
+    get_breaker().success(parse.urlsplit(url).netloc)
+    observe_response(host, started, page.status_code, page.headers)
+
+    status = update_cache(url, page.status_code, page.headers)
+    if status != page.status_code:
+        get_session().drain(page)
+        page.close()
+        return CachedResponse(url, status)
+    return page
+
+
+def get_reader(encoding):
+    # Pages for the parser processes are read as text, otherwise the chosen extractor sees the page as it arrives
+    return PageReader(encoding, args.max_bytes, args.parser if parse_executor is None else None)
+
+
+def get_session():
+    # Shared keep-alive session, created on first use when called outside crawl_threaded
+    global connection_stats, session_pool
+    if session_pool is None:
+        if connection_stats is None:
+            connection_stats = ConnectionStats()
+        session_pool = SessionPool(args.pool_size, {"User-Agent": args.user_agent}, connection_stats)
+    return session_pool
+
+
+def get_urls(limit=-1):
+    # Yields (url, depth) of unchecked URLs, shallowest first, read through the pending index
+    flush_db()
     with closing(get_connection()) as conn:
         try:
-            conn.row_factory = lambda cursor, row: row[0]
             cursor = conn.execute(
-                'SELECT url FROM url WHERE status IS NULL ORDER BY url;')
-            return cursor.fetchall()
+                'SELECT url, depth FROM url WHERE status IS NULL ORDER BY depth, url_id LIMIT ?;', [limit])
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    break
+                yield from rows
         except sqlite3.Error as e:
             logging.error("Database error: %s" % e)
-            return None
 
 
-def initialize_db(reset=False):
+def hash_url(url):
+    # url_hash of the compact schema, a signed 32 bit CRC so SQLite stores it in 4 bytes
+    return zlib.crc32(url.encode("utf-8")) - 2 ** 31
+
+
+def init_parse_process(log_level, log_file):
+    # Spawned parser processes log to the same file as the crawler
+    logging.basicConfig(
+        level=log_level,
+        filename=log_file,
+        filemode="a",
+        format="%(asctime)s\t%(levelname)s\t%(message)s")
+
+
+def initialize_db(reset=False, compact=False):
+    # The compact schema is used for a new database when asked for, an existing database keeps the one it was created with
+    global compact_db
     with closing(get_connection()) as conn:
         try:
             if reset:
@@ -224,15 +957,59 @@ def initialize_db(reset=False):
                 conn.executescript(
                     'DROP TABLE IF EXISTS links; DROP TABLE IF EXISTS url;')
                 conn.commit()
+                if url_cache is not None:
+                    url_cache.clear()
+                if seen_filter is not None:
+                    seen_filter.clear()
+
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(url);')]
+            compact_db = "url_hash" in columns if columns else compact
+            if compact and not compact_db:
+                logging.warning("%s was created without --compact-db and keeps its schema, use --reset to start over with a compact one." % db_name)
 
             # Create url table if not exists
-            logging.info("Initializing database tables")
-            conn.executescript('''
-                CREATE TABLE IF NOT EXISTS url (url_id INTEGER PRIMARY KEY, url TEXT NOT NULL, status INTEGER, parsed INTEGER, notes TEXT);
-                CREATE TABLE IF NOT EXISTS links (parent_id INTEGER, child_id INTEGER, url_count INTEGER, PRIMARY KEY(parent_id, child_id), FOREIGN KEY (parent_id) REFERENCES url (url_id), FOREIGN KEY (child_id) REFERENCES url (url_id));
-                CREATE UNIQUE INDEX IF NOT EXISTS urls ON url(url);
-                CREATE UNIQUE INDEX IF NOT EXISTS mapping ON links(parent_id, child_id);
-                ''')
+            logging.info("Initializing %s database tables" % ("compact" if compact_db else "standard"))
+            if compact_db:
+                # URLs are found through a 4 byte hash of their text rather than a unique index holding a second copy of it
+                # links is keyed on its columns alone, and the report reads broken URLs and their parents from indexes
+                conn.executescript('''
+                    CREATE TABLE IF NOT EXISTS url (url_id INTEGER PRIMARY KEY, url TEXT NOT NULL, url_hash INTEGER NOT NULL, status INTEGER, parsed INTEGER, notes TEXT, depth INTEGER, checked REAL, state INTEGER NOT NULL DEFAULT 0);
+                    CREATE TABLE IF NOT EXISTS links (parent_id INTEGER NOT NULL, child_id INTEGER NOT NULL, url_count INTEGER, PRIMARY KEY(parent_id, child_id), FOREIGN KEY (parent_id) REFERENCES url (url_id), FOREIGN KEY (child_id) REFERENCES url (url_id)) WITHOUT ROWID;
+                    CREATE INDEX IF NOT EXISTS url_hashes ON url(url_hash);
+                    CREATE INDEX IF NOT EXISTS errors ON url(status) WHERE status > 403 OR status IN (0, -1);
+                    CREATE INDEX IF NOT EXISTS parents ON links(child_id, parent_id, url_count);
+                    ''')
+            else:
+                conn.executescript('''
+                    CREATE TABLE IF NOT EXISTS url (url_id INTEGER PRIMARY KEY, url TEXT NOT NULL, status INTEGER, parsed INTEGER, notes TEXT, depth INTEGER, checked REAL, state INTEGER NOT NULL DEFAULT 0);
+                    CREATE TABLE IF NOT EXISTS links (parent_id INTEGER, child_id INTEGER, url_count INTEGER, PRIMARY KEY(parent_id, child_id), FOREIGN KEY (parent_id) REFERENCES url (url_id), FOREIGN KEY (child_id) REFERENCES url (url_id));
+                    CREATE UNIQUE INDEX IF NOT EXISTS urls ON url(url);
+                    CREATE UNIQUE INDEX IF NOT EXISTS mapping ON links(parent_id, child_id);
+                    ''')
+
+            # Databases from earlier versions lack the depth column
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(url);')]
+            if "depth" not in columns:
+                logging.info("Adding depth column to url table")
+                conn.execute('ALTER TABLE url ADD COLUMN depth INTEGER;')
+                conn.execute('UPDATE url SET depth=1 WHERE depth IS NULL AND status IS NULL;')
+            if "checked" not in columns:
+                logging.info("Adding checked column to url table")
+                conn.execute('ALTER TABLE url ADD COLUMN checked REAL;')
+            if "state" not in columns:
+                logging.info("Adding state column to url table")
+                conn.execute('ALTER TABLE url ADD COLUMN state INTEGER NOT NULL DEFAULT 0;')
+                conn.execute('UPDATE url SET state=? WHERE status IS NOT NULL;', [state_done])
+
+            # URLs in flight when the last run stopped are pending again, and reported so a resume can be followed
+            interrupted = conn.execute('UPDATE url SET state=? WHERE state=?;', [state_pending, state_in_flight]).rowcount
+            counts = dict(conn.execute('SELECT state, COUNT(*) FROM url GROUP BY state;'))
+            if counts:
+                logging.info("Resuming crawl: %d URLs done, %d pending of which %d were in flight when it stopped." % (
+                    counts.get(state_done, 0), counts.get(state_pending, 0), interrupted))
+
+            # Only unchecked URLs are indexed, so pulling the next pending ones stays cheap on large crawls
+            conn.execute('CREATE INDEX IF NOT EXISTS pending ON url(depth, url_id) WHERE status IS NULL;')
             conn.commit()
         except sqlite3.Error as e:
             logging.error("Database error: %s" % e)
@@ -241,81 +1018,384 @@ def initialize_db(reset=False):
     return True
 
 
-def parse_content(base, content):
-    soup = BeautifulSoup(content, "html.parser")
+def insert_url(url, depth=None):
+    # Returns (url_id, scheduled), scheduled is True if the URL is new or was found at a shallower depth than before
+    return insert_urls([url], depth)[url]
 
-    links = []
-    refs = soup.find_all("a", href=True)
-    for a in refs:
-        link = parse.urljoin(base, a['href'], False)
-        logging.info("Found: " + link)
-        if validate_url(link):
-            links.append(parse_url(link, not args.no_query, args.acceptable_keys))
 
+def insert_urls(urls, depth=None):
+    # insert_url for many URLs, returning {url: (url_id, scheduled)}
+    # URLs the cache can't answer are looked up and inserted in a single database operation
+    results = {}
+    pending = {}  # link without fragment -> (maybe_seen, urls standing for it)
+    for url in urls:
+        link = parse.urldefrag(url).url
+        if link in pending:
+            pending[link][1].append(url)
+            continue
+
+        # Without a seen filter every URL might be known, with one only URLs it reports as possibly seen
+        maybe_seen = seen_filter is None or seen_filter.add(link)
+
+        if maybe_seen and url_cache is not None:
+            cached = url_cache.get(link)
+            if cached is not None and (depth is None or cached[1] is not None and cached[1] <= depth):
+                results[url] = (cached[0], False)
+                continue
+        pending[link] = (maybe_seen, [url])
+    if not pending:
+        return results
+
+    def known(conn, link, url_id, known_depth, status):
+        if depth is not None and (known_depth is None or depth < known_depth):
+            logging.info("URL '%s' found at shallower depth %d." % (link, depth))
+            conn.execute('UPDATE url SET depth=? WHERE url_id=?;', [depth, url_id])
+
+            # A checked URL is pending again if it now falls within the parsed depth
+            if status is not None and known_depth is not None and 0 < args.depth and depth < args.depth:
+                conn.execute('UPDATE url SET status=NULL, state=? WHERE url_id=?;', [state_pending, url_id])
+                status = None
+            return url_id, depth, status is None
+        return url_id, known_depth, False
+
+    def add(conn, link):
+        try:
+            logging.info("Adding URL '%s' to database." % link)
+            if compact_db:
+                # No index stops a duplicate here, in compact mode write looks every link up before adding it
+                c = conn.execute('INSERT INTO url (url, url_hash, depth) VALUES (?, ?, ?);', [link, hash_url(link), depth])
+            else:
+                c = conn.execute('INSERT INTO url (url, depth) VALUES (?, ?);', [link, depth])
+            return c.lastrowid, depth, True
+        except sqlite3.IntegrityError:
+            logging.warning("URL '%s' already found in database." % link)
+            return known(conn, link, *conn.execute(
+                'SELECT url_id, depth, status FROM url WHERE url=?', [link]).fetchone())
+
+    def write(conn):
+        try:
+            # URLs the filter has possibly seen are looked up first, avoiding failing INSERTs
+            # The compact schema has no unique index to fall back on, and another thread may have added a link
+            # the filter took as new since it was checked, so there every link is looked up
+            lookup = [link for link, (maybe_seen, _) in pending.items() if maybe_seen or compact_db]
+            rows = {}
+            for start in range(0, len(lookup), max_sql_params):
+                chunk = lookup[start:start + max_sql_params]
+                if compact_db:
+                    # Rows of other URLs sharing a hash come back too, they are never looked up in rows
+                    query = 'SELECT url, url_id, depth, status FROM url WHERE url_hash IN (%s);'
+                    chunk = [hash_url(link) for link in chunk]
+                else:
+                    query = 'SELECT url, url_id, depth, status FROM url WHERE url IN (%s);'
+                for row in conn.execute(query % ",".join("?" * len(chunk)), chunk):
+                    rows[row[0]] = row[1:]
+            return {link: known(conn, link, *rows[link]) if link in rows else add(conn, link) for link in pending}
+        except sqlite3.Error as e:
+            logging.debug("Database error: %s" % e)
+            logging.critical("Database error - ensure database is writable.")
+            return {}
+
+    written = write_db(write)
+    for link, (_, link_urls) in pending.items():
+        url_id, known_depth, scheduled = written.get(link, (None, None, False))
+        if url_cache is not None and url_id is not None:
+            url_cache.put(link, (url_id, known_depth))
+        # Only the first of several URLs differing by fragment is scheduled
+        for url in link_urls:
+            results[url] = (url_id, scheduled)
+            scheduled = False
+    return results
+
+
+def is_connect_error(error):
+    # True for failures to reach a host at all, rather than a host answering slowly or badly
+    if isinstance(error, (requests.exceptions.ConnectTimeout, aiohttp.ClientConnectorError)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, requests.urllib3.exceptions.NewConnectionError)
+    return isinstance(error, aiohttp.ServerTimeoutError) and str(error).startswith("Connection timeout")
+
+
+def load_seen_filter():
+    # Rebuilds seen_filter from every URL of a resumed crawl
+    if seen_filter is None:
+        return
+    with closing(get_connection()) as conn:
+        try:
+            cursor = conn.execute('SELECT url FROM url;')
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    break
+                for row in rows:
+                    seen_filter.add(row[0])
+            logging.info("Loaded %d URLs into seen filter." % len(seen_filter))
+        except sqlite3.Error as e:
+            logging.error("Database error: %s" % e)
+
+
+def load_sitemap():
+    # Reads --sitemap, or the sitemaps in robots.txt of each start host falling back to /sitemap.xml, following sitemap indexes
+    sitemap = Sitemap()
+    pending = list(args.sitemap or [])
+    if not pending:
+        for url in args.url:
+            split = parse.urlsplit(url)
+            root = split.scheme + "://" + split.netloc
+            robots = get_content_bytes(root + "/robots.txt") or b""
+            listed = [line.split(b":", 1)[1].strip().decode("utf-8", "replace")
+                      for line in robots.splitlines() if line.lower().startswith(b"sitemap:")]
+            pending.extend(listed or [root + "/sitemap.xml"])
+
+    read = set()
+    while pending and len(read) < max_sitemaps:
+        url = pending.pop(0)
+        if url in read:
+            continue
+        read.add(url)
+        content = get_content_bytes(url)
+        if content is None:
+            continue
+        try:
+            pending.extend(sitemap.parse(content))
+        except Exception as e:
+            logging.warning("Could not read sitemap %s: %s" % (url, e))
+
+    logging.info("Read %d URLs from %d sitemaps." % (len(sitemap), len(read)))
+    return sitemap
+
+
+def load_url_cache():
+    # Warms url_cache with the most recently added URLs of a resumed crawl
+    with closing(get_connection()) as conn:
+        try:
+            cursor = conn.execute(
+                'SELECT url, url_id, depth FROM url ORDER BY url_id DESC LIMIT ?;', [url_cache.capacity])
+            url_cache.warm((url, (url_id, depth)) for url, url_id, depth in reversed(cursor.fetchall()))
+            logging.info("Loaded %d URLs into cache." % len(url_cache))
+        except sqlite3.Error as e:
+            logging.error("Database error: %s" % e)
+
+
+def log_progress():
+    # One line telling whether the crawl is waiting on the network, the parser or the database
+    if db_writer is not None:
+        metrics.gauge("db_queue", db_writer.ops.qsize())
+    checked = metrics.total("urls_checked")
+    gauges = metrics.to_dict()["gauges"]
+    line = "Progress: %d URLs checked (%.1f/s), %d queued, %d in flight, %.1f MB downloaded | fetch %s, parse %s, db wait %s, db queue %d" % (
+        checked, checked / max(metrics.elapsed, 1e-9), gauges.get("frontier_queued", 0), gauges.get("in_flight", 0),
+        metrics.total("bytes_downloaded") / 2 ** 20, mean_ms("fetch_seconds"), mean_ms("parse_seconds"),
+        mean_ms("db_wait_seconds"), gauges.get("db_queue", 0))
+    if "concurrency_limit" in gauges:
+        line += ", concurrency limit %d" % gauges["concurrency_limit"]
+    logging.info(line)
+    print(line, file=sys.stderr)
+
+
+def log_time_spent():
+    # Summed over all workers, so totals can exceed the elapsed time
+    logging.info("Time spent in %.1f s: fetching %.1f s, waiting on host limits %.1f s, parsing %.1f s, waiting on the database %.1f s, database writes %.1f s, commits %.1f s" % (
+        metrics.elapsed, *(metrics.summary(name).sum for name in (
+            "fetch_seconds", "host_wait_seconds", "parse_seconds", "db_wait_seconds", "db_write_seconds", "db_commit_seconds"))))
+
+
+def mark_changed_pages(sitemap):
+    # Makes the pages an incremental crawl parsed pending again unless the sitemap shows them unchanged since checked
+    # Pages without a sitemap lastmod are fetched with a conditional request, sitemap URLs not crawled yet are added
+    lastmods = {}
+    for loc, lastmod in sitemap.lastmod.items():
+        url = canonicalize_url(loc, loc, not args.no_query, tuple(args.acceptable_keys) if args.acceptable_keys else None)
+        if url is not None and parse.urlsplit(url).hostname in args.base:
+            lastmods[url] = lastmod
+
+    def write(conn):
+        try:
+            changed = []
+            for url_id, url, checked in conn.execute(
+                    'SELECT url_id, url, checked FROM url WHERE parsed=1 AND status=200;').fetchall():
+                if parse.urlsplit(url).hostname not in args.base:
+                    continue
+                lastmod = lastmods.get(url)
+                if lastmod is None or checked is None or lastmod > checked:
+                    changed.append(url_id)
+            conn.executemany('UPDATE url SET status=NULL, state=? WHERE url_id=?;', [(state_pending, url_id) for url_id in changed])
+
+            added = conn.total_changes
+            if compact_db:
+                conn.executemany('INSERT INTO url (url, url_hash, depth) SELECT ?, ?, 1 WHERE NOT EXISTS (SELECT 1 FROM url WHERE url_hash=? AND url=?);',
+                                 [(url, hash_url(url), hash_url(url), url) for url in lastmods])
+            else:
+                conn.executemany('INSERT OR IGNORE INTO url (url, depth) VALUES (?, 1);', [(url,) for url in lastmods])
+            return len(changed), conn.total_changes - added
+        except sqlite3.Error as e:
+            logging.error("Database error: %s" % e)
+            return 0, 0
+
+    changed, added = write_db(write)
+    logging.info("Incremental crawl: %d parsed pages to recheck, %d new URLs from sitemaps." % (changed, added))
+
+
+def mark_in_flight(url):
+    # Records that url was handed to a worker, so a restart can tell interrupted URLs from untouched ones
+    def write(conn):
+        try:
+            if compact_db:
+                conn.execute('UPDATE url SET state=? WHERE url_hash=? AND url=? AND status IS NULL;', [state_in_flight, hash_url(url), url])
+            else:
+                conn.execute('UPDATE url SET state=? WHERE url=? AND status IS NULL;', [state_in_flight, url])
+        except sqlite3.Error as e:
+            logging.error("Database error: %s" % e)
+
+    write_db(write, wait=False)
+
+
+def mean_ms(name):
+    mean = metrics.summary(name).mean
+    return "-" if mean is None else "%.1f ms" % (mean * 1000)
+
+
+def observe_response(host, started, status, headers):
+    # Feeds a response, status 0 if the request failed, to the concurrency limit and pauses host for its Retry-After
+    if concurrency is not None:
+        concurrency.record(time.perf_counter() - started, status)
+    if status in (429, 503) and "Retry-After" in headers:
+        seconds = parse_retry_after(headers["Retry-After"])
+        if seconds:
+            logging.warning("%s answered %d, pausing it for %.0f seconds." % (host, status, min(seconds, max_retry_after)))
+            get_limiter().pause(host, min(seconds, max_retry_after))
+
+
+def parse_address(address):
+    # (host, port) of a HOST:PORT argument
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def parse_content(base, reader):
+    # Returns the links on a page read by reader, hrefs it extracted while reading only need canonicalizing
+    # The fetching thread waits on the parser processes when there are any, releasing the GIL meanwhile
+    hrefs = reader.close()
+    start = time.perf_counter()
+    if hrefs is not None:
+        links = canonicalize_links(base, hrefs, not args.no_query, args.acceptable_keys)
+    else:
+        links = parse_executor.submit(
+            extract_links, base, reader.text, not args.no_query, args.acceptable_keys, args.parser).result()
+    metrics.observe("parse_seconds", reader.seconds + time.perf_counter() - start)
     return links
 
 
-def parse_url(url, use_queries=True, keys=[]):
-    splitresult = parse.urlsplit(url)
-    parsed_url = splitresult.scheme + "://" + splitresult.netloc + splitresult.path
+def parse_retry_after(value):
+    # Seconds to wait from a Retry-After header given as seconds or as an HTTP date, or None if it can't be read
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
 
+def parse_url(url, use_queries=True, keys=[]):
     # Modify URL based on command line arguments
-    if use_queries and not keys:
-        parsed_url = parsed_url + splitresult.query
-
-    # rebuild URL with acceptable key/value pairs only
-    if keys and splitresult.query:
-        query_args = dict(x.split("=") for x in splitresult.query.split("&"))
-        parsed_query_args = []
-        for ak in keys:
-            if ak in query_args:
-                parsed_query_args.append(ak + "=" + query_args[ak])
-        
-        if parsed_query_args:
-            parsed_url = parsed_url + "?" + "&".join(parsed_query_args)
-    
+    parsed_url = build_url(parse.urlsplit(url), use_queries, keys)
+
     if url != parsed_url:
         logging.info("Parsed URL returned: " + parsed_url)
 
     return parsed_url
 
 
-def process_url(url, get_content=True):
+def process_url(url, get_content=True, depth=None, frontier=None):
     # Fetch head or head + contents for each URL, save status_code to database
+    # Returns (url, depth) of the child URLs that need checking
+    # With the frontier the URL came from, transient failures are handed back to it to retry instead of saved
     logging.info("Processing Url: %s. get_content is %s" %
                  (url, str(get_content)))
 
-    url = parse_url(url, not args.no_query, args.acceptable_keys)
+    result = check_url(url, get_content, frontier is not None and frontier.attempts(url) > 0)
+    if frontier is not None:
+        result = retry_or_keep(frontier, result, depth)
+        if result is None:
+            return []
+    return save_result(result, get_content, depth)
 
-    # Accept URL input and get page
-    with get_page(url) as page:
 
-        # add url to db
-        parentId = add_url_to_db(url)  # Inserts URL if necessary, returns Id
+def put_start_urls(frontier):
+    # Start URLs go through the database like any other, so a resumed crawl doesn't fetch them again once done
+    # The frontier reads them back with the pages an incremental crawl marked as changed and the URLs a stopped crawl left
+    for url in args.url:
+        insert_url(parse_url(url, not args.no_query, args.acceptable_keys), 0)
 
-        # get status code of url
-        status = page.status_code
 
-        # update status of current page
-        update_url_status(parentId, status, get_content)
+def record_result(url, depth, result, frontier=None):
+    # Saves a check_url result reported by a worker, returning (url, depth) of the children to queue
+    metrics.count("urls_checked", label=result[1])
+    if frontier is not None:
+        result = retry_or_keep(frontier, result, depth)
+        if result is None:
+            return []
+    return save_result(result, args.depth == 0 or depth < args.depth, depth)
 
-        # if page.history (??) then add each page and status code to db, add page.url (the final redirected url) to db
-        if len(page.history) > 0:
-            update_url_status(add_url_to_db(page.url), page.status_code, get_content)
 
-        # if current url is in args.base, and get_content, and url status code is OK, finally page is of the appropriate type, then scrape page for new links
-        # for each link, add to the url, returning child ID, add to links table
-        if (parse.urlsplit(url).hostname in args.base
-            and get_content
-            and status == 200
-            and "text/html" in page.headers['content-type']):
-            links = parse_content(url, page.text)
+def recheck_url(url_id):
+    # Makes a URL checked before this run pending again, returning its depth, or None if it was not
+    def write(conn):
+        try:
+            cursor = conn.execute(
+                'UPDATE url SET status=NULL, state=? WHERE url_id=? AND status IS NOT NULL AND (checked IS NULL OR checked < ?);',
+                [state_pending, url_id, run_started])
+            if cursor.rowcount > 0:
+                return conn.execute('SELECT depth FROM url WHERE url_id=?;', [url_id]).fetchone()[0]
+        except sqlite3.Error as e:
+            logging.error("Database error: %s" % e)
+        return None
+
+    return write_db(write)
+
+
+def retry_or_keep(frontier, result, depth):
+    # Hands a transient failure back to the frontier to retry after an exponential backoff, returning None
+    # Otherwise returns the result to save, noting how many attempts a failure took
+    # Half of each delay is random, so URLs that failed together are not all retried at once
+    url, status, redirect, links, notes = result
+    attempts = frontier.attempts(url)
+    if status in transient_status:
+        failure = str(status)
+    elif status == 0 and notes is not None and notes.partition(":")[0] in transient_errors:
+        failure = notes.partition(":")[0]
+    else:
+        failure = None
+
+    if failure is not None and attempts < args.retries:
+        delay = min(max_retry_delay, args.retry_delay * 2 ** attempts)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        delay = max(delay, get_limiter().paused(parse.urlsplit(url).hostname))  # Not before a Retry-After is over
+        logging.info("Retrying %s in %.1f seconds after %s, attempt %d of %d." % (url, delay, notes or status, attempts + 1, args.retries + 1))
+        metrics.count("retries", label=failure)
+        frontier.defer(url, depth, delay)
+        return None
+    if failure is not None and attempts > 0:
+        notes = "%s (%d attempts)" % (notes or "HTTP %d" % status, attempts + 1)
+    return url, status, redirect, links, notes
+
+
+def save_result(result, get_content=True, depth=None):
+    # Records a check_url result, returning (url, depth) of the child URLs that need checking
+    url, status, redirect, links, notes = result
 
-            for link in links:
-                childId = add_url_to_db(link)
-                add_link(parentId, childId)
+    # add url to db, then for each link, add to the url, returning child ID, add to links table
+    parentId = add_url_to_db(url, depth)  # Inserts URL if necessary, returns Id
+    children = [] if links is None else update_links(parentId, links, depth)
+    if redirect is not None:
+        update_url_status(add_url_to_db(redirect, depth), status, get_content)
 
-        time.sleep(0.5 * random.randint(1, 5))
+    # The status is written last, writes are committed in order so a crash never leaves a page done without its links
+    update_url_status(parentId, status, get_content, notes)
+    return children
 
 
 def set_db(filename):
@@ -323,15 +1403,77 @@ def set_db(filename):
     db_name = filename
 
 
-def update_url_status(url_id, status, parsed):
-    with closing(get_connection()) as conn:
+def skipped_response(url):
+    # Response for a URL on a host given up on, skipped_status tells it apart from links that were fetched or failed
+    host = parse.urlsplit(url).netloc
+    metrics.count("dead_host_skips", label=host)
+    return FailedResponse(url, skipped_status, "Not fetched, %s failed to connect %d times in a row: %s" % (
+        host, args.host_failures, get_breaker().dead(host)))
+
+
+def truncation_note(url, reader):
+    # Note for pages cut off at --max-bytes, their links past the cutoff were never seen
+    if not reader.truncated:
+        return None
+    logging.warning("%s is larger than %d bytes, page partially parsed." % (url, args.max_bytes))
+    return "Truncated at %d bytes, page partially parsed" % args.max_bytes
+
+
+def update_cache(url, status, headers):
+    # Records a check of url, returning the cached status in place of a 304 Not Modified
+    # Transient statuses are not kept, a later run would otherwise trust them without checking again
+    if status_cache is None or status in transient_status:
+        return status
+
+    if status == 304:
+        entry = status_cache.get(url)
+        if entry is not None:
+            logging.info("%s not modified, using cached status %d." % (url, entry[0]))
+            status_cache.touch(url)
+            return entry[0]
+
+    status_cache.put(url, status, headers.get("ETag"), headers.get("Last-Modified"))
+    return status
+
+
+def update_frontier_gauges(frontier):
+    metrics.gauge("frontier_queued", len(frontier))
+    metrics.gauge("in_flight", len(frontier.in_flight))
+
+
+def update_links(parentId, links, depth=None):
+    # Replaces the links of a parsed page, returning (url, depth) of the child URLs that need checking
+    # Repeated links are counted first, so the database only sees each distinct link once, in bulk
+    # Incremental crawls also recheck known URLs the page did not link to before, at the depth they were found
+    counts = Counter(links)
+    old_children = get_children(parentId) if args.incremental else None
+    delete_links(parentId)  # Rechecked pages replace their links rather than counting them twice
+
+    children = []
+    child_depth = None if depth is None else depth + 1
+    ids = insert_urls(counts, child_depth)
+    add_links(parentId, [(ids[link][0], count) for link, count in counts.items() if ids[link][0] is not None])
+    for link in counts:
+        childId, scheduled = ids[link]
+        if childId is None:
+            continue
+        if scheduled:
+            children.append((link, child_depth))
+        elif old_children is not None and childId not in old_children:
+            known_depth = recheck_url(childId)
+            if known_depth is not None:
+                children.append((link, known_depth))
+    return children
+
+
+def update_url_status(url_id, status, parsed, notes=None):
+    def write(conn):
         try:
-            logging.info("Updating %d | status: %d | parsed: %d" %
-                         (url_id, status, parsed))
-            cursor = conn.execute('UPDATE url SET status=?, parsed=? WHERE url_id=?;', [
-                                  status, parsed, url_id])
+            logging.info("Updating %d | status: %d | parsed: %d | notes: %s" %
+                         (url_id, status, parsed, notes))
+            cursor = conn.execute('UPDATE url SET status=?, parsed=?, notes=?, checked=?, state=? WHERE url_id=?;', [
+                                  status, parsed, notes, time.time(), state_done, url_id])
             if cursor.rowcount > 0:
-                conn.commit()
                 logging.info("Record updated.")
         except sqlite3.IntegrityError:
             logging.warning("Integrity error updating status.")
@@ -339,6 +1481,8 @@ def update_url_status(url_id, status, parsed):
         except sqlite3.Error as e:
             logging.error("Database error: %s" % e)
 
+    write_db(write, wait=False)
+
 
 def validate_url(url):
     logging.info("Validating URL: %s" % str(url))
@@ -356,16 +1500,81 @@ def validate_url(url):
         logging.debug(ex)
         return False
 
+
+def write_report():
+    # Streams the broken links into report_log in --report-format, then opens it unless --no-browser
+    report_format = args.report_format or os.path.splitext(report_log)[1][1:].lower()
+    if report_format not in REPORTS:
+        report_format = "html"
+    logging.info("Creating link report.")
+    with open(report_log, "w", newline="") as f:
+        report = REPORTS[report_format](f)
+        for row in get_error_urls(args.ignore_status):
+            report.write(row)
+        report.close()
+    logging.info("Report of %d broken links written to %s." % (report.rows, report_log))
+    if not args.no_browser:
+        webbrowser.open('file://' + os.path.realpath(report_log), new=2)
+
+
+def write_db(func, wait=True):
+    # Runs func(conn) on the batched writer while a crawl is running, otherwise on its own connection
+    if db_writer is not None:
+        if wait:
+            with metrics.timer("db_wait_seconds"):
+                return db_writer.submit(func).result()
+        db_writer.execute(func)
+        return True
+
+    with closing(get_connection()) as conn:
+        result = func(conn)
+        conn.commit()
+        return result
+
+class CrawlManager(BaseManager):
+    # Serves the coordinator's lease queue to workers, typeids are registered by crawl_coordinator and crawl_worker
+    pass
+
+class CachedResponse:
+    # Dummy response for links answered from the status cache without downloading anything
+    def __init__(self, url, status):
+        self.url = url
+        self.status_code = status
+        self.status = status
+        self.history = []
+        self.headers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        return
+
 class FailedResponse:
-    # Dummy class for responses that fail outright, typically due to non-existent server. Returns 404 so link shows up and can be dealt with as appropriate.
-    def __init__(self, url):
+    # Dummy class for responses that fail outright, typically due to non-existent server
+    # Status 0 shows the link was never answered, notes says why
+    def __init__(self, url, status=0, notes=None):
         self.url = url
-        self.status_code = 404
+        self.notes = notes
+        self.status_code = status
+        self.status = self.status_code  # aiohttp naming, used by the async engine
         self.history = []
-        self.headers = []
+        self.headers = {}
     
     def __enter__(self):
         return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        return
     
     def __exit__(self, type, value, traceback):
         # Just a dummy response, no need to close anything